@@ -83,6 +83,8 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
+        # the test database is created from the models, the committed migrations do not cover all of them
+        'TEST': {'MIGRATE': False},
     }
 }
 
@@ -127,3 +129,78 @@ STATIC_URL = 'static/'
 # https://docs.djangoproject.com/en/4.0/ref/settings/#default-auto-field
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
+
+
+# Fakturownia API
+# read once here, the client is created on first use
+
+FAKTUROWNIA_URL = env('FAKTUROWNIA_URL', default="https://marcelipl.fakturownia.pl")
+
+FAKTUROWNIA_API_TOKEN = env('API_TOKEN', default=None)
+
+FAKTUROWNIA_POOL_SIZE = env.int('FAKTUROWNIA_POOL_SIZE', default=10)
+
+FAKTUROWNIA_CONNECT_TIMEOUT = env.float('FAKTUROWNIA_CONNECT_TIMEOUT', default=5)
+
+FAKTUROWNIA_READ_TIMEOUT = env.float('FAKTUROWNIA_READ_TIMEOUT', default=30)
+
+FAKTUROWNIA_RETRIES = env.int('FAKTUROWNIA_RETRIES', default=3)
+
+# client side rate limits in requests a second and the burst allowed after a quiet period,
+# reads and writes are limited separately
+FAKTUROWNIA_READ_RATE = env.float('FAKTUROWNIA_READ_RATE', default=5)
+
+FAKTUROWNIA_READ_BURST = env.int('FAKTUROWNIA_READ_BURST', default=10)
+
+FAKTUROWNIA_WRITE_RATE = env.float('FAKTUROWNIA_WRITE_RATE', default=2)
+
+FAKTUROWNIA_WRITE_BURST = env.int('FAKTUROWNIA_WRITE_BURST', default=4)
+
+# how many times a request answered with 429 is sent again
+FAKTUROWNIA_THROTTLE_RETRIES = env.int('FAKTUROWNIA_THROTTLE_RETRIES', default=5)
+
+
+# Odoo XML-RPC API
+# read once here, the client authenticates on first call
+
+ODOO_URL = env('URL', default=None)
+
+ODOO_DB = env('DB', default=None)
+
+ODOO_USERNAME = env('ODOO_USERNAME', default=None)
+
+ODOO_PASSWORD = env('PASSWORD', default=None)
+
+ODOO_POOL_SIZE = env.int('ODOO_POOL_SIZE', default=4)
+
+ODOO_CONNECT_TIMEOUT = env.float('ODOO_CONNECT_TIMEOUT', default=5)
+
+# read timeout of a single call
+ODOO_TIMEOUT = env.float('ODOO_TIMEOUT', default=60)
+
+ODOO_RETRIES = env.int('ODOO_RETRIES', default=3)
+
+ODOO_COMPRESS = env.bool('ODOO_COMPRESS', default=False)
+
+ODOO_MULTICALL = env.bool('ODOO_MULTICALL', default=True)
+
+ODOO_MULTICALL_BATCH_SIZE = env.int('ODOO_MULTICALL_BATCH_SIZE', default=100)
+
+
+# Outbound calls
+# idempotent calls failing on network errors or 5xx are retried with jittered exponential backoff,
+# a client fails fast for CIRCUIT_RESET_TIMEOUT seconds after CIRCUIT_FAILURE_THRESHOLD failures in a row
+
+RETRY_BACKOFF = env.float('RETRY_BACKOFF', default=0.5)
+
+RETRY_MAX_BACKOFF = env.float('RETRY_MAX_BACKOFF', default=10)
+
+CIRCUIT_FAILURE_THRESHOLD = env.int('CIRCUIT_FAILURE_THRESHOLD', default=5)
+
+CIRCUIT_RESET_TIMEOUT = env.float('CIRCUIT_RESET_TIMEOUT', default=30)
+
+# rate limiter state shared by the web process and job workers
+RATE_LIMIT_FILE = env('RATE_LIMIT_FILE', default=str(BASE_DIR / 'ratelimit.sqlite3'))
+
+# seconds a throttled client takes to get back to its configured rate
+RATE_LIMIT_RECOVERY = env.float('RATE_LIMIT_RECOVERY', default=60)
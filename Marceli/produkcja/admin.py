@@ -1,5 +1,5 @@
 from django.contrib import admin
-from .models import Month, RW, Invoice, Product, InvoicePosition, ProductionPosition, ProductionDoc
+from .models import Month, RW, Invoice, Product, InvoicePosition, ProductionPosition, ProductionDoc, WarehouseAction, Job
 
 admin.site.register(Month)
 admin.site.register(Invoice)
@@ -8,3 +8,5 @@ admin.site.register(InvoicePosition)
 admin.site.register(ProductionPosition)
 admin.site.register(ProductionDoc)
 admin.site.register(RW)
+admin.site.register(WarehouseAction)
+admin.site.register(Job)
@@ -1,90 +1,315 @@
 import requests
-import json
 import datetime
-from .models import Product, RW, ProductionDoc
+import email.utils
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from decimal import Decimal
+from typing import Iterator
+from requests.adapters import HTTPAdapter
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import transaction
+from django.db.models import Max, Sum
+from django.utils.functional import SimpleLazyObject
+from .models import Product, RW, ProductionDoc, WarehouseAction
+from .resilience import CircuitBreaker, RateLimiter, Retry, RetryableResult
 
-import environ
+INVOICES_ENDPOINT = "invoices.json"
+WAREHOUSE_DOC_ENDPOINT = "warehouse_documents.json"
+WAREHOUSE_ACTIONS_ENDPOINT = "warehouse_actions.json"
 
-env = environ.Env()
-environ.Env.read_env()
+# fakturownia caps list endpoints at 100 documents per page
+PER_PAGE = 100
+# how many pages are fetched in the background while the current one is processed
+PAGES_AHEAD = 2
+# product warehouse - sales from it are produced
+PRODUCTS_WAREHOUSE_ID = 6033
+# incremental warehouse action syncs start this long before the latest synced action, for actions added late
+ACTIONS_OVERLAP = datetime.timedelta(days=7)
 
-API_TOKEN = env('API_TOKEN')
-INVOICES_ENDPOINT = "https://marcelipl.fakturownia.pl/invoices.json"
-WAREHOUSE_DOC_ENDPOINT = "https://marcelipl.fakturownia.pl/warehouse_documents.json"
-WAREHOUSE_ACTIONS_ENDPOINT = "https://marcelipl.fakturownia.pl/warehouse_actions.json"
+# (connect, read) timeouts in seconds by endpoint, others use the FAKTUROWNIA_*_TIMEOUT settings;
+# a page of invoices with positions is the slowest response
+ENDPOINT_TIMEOUTS = {
+    'invoices': (5, 120),
+    'warehouse_actions': (5, 60),
+}
+IDEMPOTENT_METHODS = {'GET', 'HEAD', 'PUT', 'DELETE'}
+READ_METHODS = {'GET', 'HEAD'}
+RETRY_STATUSES = {500, 502, 503, 504}
+TOO_MANY_REQUESTS = 429
 
 
 def format_date(date: datetime.date) -> str:
     return date.strftime("%Y-%m-%d")
 
-class Fakturownia():
-    def __init__(self):
-        self.API_TOKEN = env('API_TOKEN')
-        self.INVOICES_ENDPOINT = "https://marcelipl.fakturownia.pl/invoices.json"
-        self.WAREHOUSE_DOC_ENDPOINT = "https://marcelipl.fakturownia.pl/warehouse_documents.json"
-        self.WAREHOUSE_ACTIONS_ENDPOINT = "https://marcelipl.fakturownia.pl/warehouse_actions.json"
 
-    def get_list(self, parameters, endpoint):
-        response = requests.get(endpoint, parameters)
-        return response.json()
+# seconds to wait from a Retry-After header, given in seconds or as an http date
+def retry_after(response: requests.Response):
+    value = response.headers.get('Retry-After')
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        until = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if until.tzinfo is None:
+        until = until.replace(tzinfo=datetime.timezone.utc)  # a -0000 zone parses as naive utc
+    return max(0.0, (until - datetime.datetime.now(datetime.timezone.utc)).total_seconds())
+
+
+def default_limiter() -> RateLimiter:
+    return RateLimiter(settings.RATE_LIMIT_FILE, {
+        'fakturownia:read': (settings.FAKTUROWNIA_READ_RATE, settings.FAKTUROWNIA_READ_BURST),
+        'fakturownia:write': (settings.FAKTUROWNIA_WRITE_RATE, settings.FAKTUROWNIA_WRITE_BURST),
+    }, recovery=settings.RATE_LIMIT_RECOVERY)
+
+
+class Fakturownia:
+    def __init__(self, api_token: str = None, base_url: str = None, pool_size: int = None,
+                 timeout: tuple = None, retry: Retry = None, breaker: CircuitBreaker = None,
+                 limiter: RateLimiter = None):
+        self.api_token = api_token or settings.FAKTUROWNIA_API_TOKEN
+        if not self.api_token:
+            raise ImproperlyConfigured("API_TOKEN for Fakturownia is not set")
+        self.base_url = (base_url or settings.FAKTUROWNIA_URL).rstrip("/")
+        # keep-alive connections kept open per host, also the max number of parallel requests
+        self.pool_size = pool_size or settings.FAKTUROWNIA_POOL_SIZE
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=self.pool_size, pool_maxsize=self.pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.session.headers.update({
+            'accept': "application/json",
+            'content-type': "application/json",
+        })
+        self.session.params = {"api_token": self.api_token}
+
+        self.timeout = timeout or (settings.FAKTUROWNIA_CONNECT_TIMEOUT, settings.FAKTUROWNIA_READ_TIMEOUT)
+        self.retry = retry or Retry(settings.FAKTUROWNIA_RETRIES, settings.RETRY_BACKOFF, settings.RETRY_MAX_BACKOFF,
+                                    retry_on=(requests.ConnectionError, requests.Timeout))
+        self.breaker = breaker or CircuitBreaker("Fakturownia", settings.CIRCUIT_FAILURE_THRESHOLD,
+                                                 settings.CIRCUIT_RESET_TIMEOUT)
+        # requests of all threads and processes stay under fakturownia's limits, reads and writes separately
+        self.limiter = limiter or default_limiter()
+        self.throttle_retries = settings.FAKTUROWNIA_THROTTLE_RETRIES
+
+    def url(self, endpoint: str) -> str:
+        return f"{self.base_url}/{endpoint}"
+
+    def endpoint_timeout(self, endpoint: str) -> tuple:
+        return ENDPOINT_TIMEOUTS.get(endpoint.split("/")[0].split(".")[0], self.timeout)
+
+    # network errors and 5xx answers are retried for idempotent methods; after the last retry
+    # a 5xx response is returned as it is.
+    # 429 answers are sent again for any method once Retry-After passes, as throttled requests are not
+    # processed; they slow the limiter down and do not count against the circuit breaker
+    def request(self, method: str, endpoint: str, **kwargs) -> requests.Response:
+        timeout = self.endpoint_timeout(endpoint)
+        bucket = 'fakturownia:read' if method in READ_METHODS else 'fakturownia:write'
+
+        def send():
+            for attempt in range(self.throttle_retries + 1):
+                self.limiter.acquire(bucket)
+                response = self.session.request(method, self.url(endpoint), timeout=timeout, **kwargs)
+                if response.status_code != TOO_MANY_REQUESTS:
+                    break
+                wait = retry_after(response)
+                if wait is None:
+                    wait = min(self.retry.max_backoff, self.retry.backoff * 2 ** attempt)
+                print(f"Fakturownia throttled {method} {endpoint}, waiting {wait:.1f} s")
+                self.limiter.throttled(bucket, wait)
+            if response.status_code in RETRY_STATUSES:
+                raise RetryableResult(response)
+            return response
+
+        return self.retry.call(send, self.breaker, retryable=method in IDEMPOTENT_METHODS)
+
+    def get(self, endpoint: str, parameters: dict = None) -> requests.Response:
+        return self.request("GET", endpoint, params=parameters)
+
+    def post(self, endpoint: str, payload: dict) -> requests.Response:
+        return self.request("POST", endpoint, json=payload)
+
+    def put(self, endpoint: str, payload: dict) -> requests.Response:
+        return self.request("PUT", endpoint, json=payload)
+
+    def get_list(self, parameters: dict, endpoint: str) -> list:
+        return self.get(endpoint, parameters).json()
+
+    # get / paginated list
+    def iter_pages(self, endpoint: str, parameters: dict, per_page: int = PER_PAGE,
+                   pages_ahead: int = PAGES_AHEAD) -> Iterator[list]:
+        def fetch(page: int) -> list:
+            return self.get_list({**parameters, "page": page, "per_page": per_page}, endpoint)
+
+        with ThreadPoolExecutor(max_workers=pages_ahead) as executor:
+            pending = deque(executor.submit(fetch, page) for page in range(1, pages_ahead + 1))
+            next_page = pages_ahead + 1
+            try:
+                while pending:
+                    documents = pending.popleft().result()
+                    if documents:
+                        yield documents
+                    if len(documents) < per_page:
+                        break  # last page
+                    pending.append(executor.submit(fetch, next_page))
+                    next_page += 1
+            finally:
+                for future in pending:
+                    future.cancel()
+
+
+_fakturownia = None
+_fakturownia_lock = threading.Lock()
+
+
+def get_fakturownia() -> Fakturownia:
+    global _fakturownia
+    with _fakturownia_lock:
+        if _fakturownia is None:
+            _fakturownia = Fakturownia()
+        return _fakturownia
+
+
+# shared client, created on first use
+fakturownia = SimpleLazyObject(get_fakturownia)
+
 
 # get / invoices
-def request_invoices(date_from: datetime, date_to: datetime) -> dict:
+def request_invoices(date_from: datetime, date_to: datetime, include_positions: bool = True) -> Iterator[dict]:
     INVOICE_API_PARAMETERS = {
-        "include_positions": "true",
+        "include_positions": "true" if include_positions else "false",
         "period": "more",
         "date_from": format_date(date_from),
         "date_to": format_date(date_to),
-        "per_page": 200,
-        "api_token": API_TOKEN,
         "kind": "vat",
     }
-    endpoint = INVOICES_ENDPOINT
-    parameters = INVOICE_API_PARAMETERS
-    response = requests.get(endpoint, parameters)
-    document_list = response.json()
-    return document_list
+    for page in fakturownia.iter_pages(INVOICES_ENDPOINT, INVOICE_API_PARAMETERS):
+        yield from page
+
+
+# get (by id) / invoices, with positions
+def request_invoices_by_id(invoice_ids: list) -> Iterator[dict]:
+    if not invoice_ids:
+        return
+    with ThreadPoolExecutor(max_workers=min(fakturownia.pool_size, len(invoice_ids))) as executor:
+        yield from executor.map(lambda invoice_id: fakturownia.get(f"invoices/{invoice_id}.json").json(), invoice_ids)
+
 
 # get / wh_documents (rws)
-def request_rws(date_from: datetime, date_to: datetime) -> dict:
+def request_rws(date_from: datetime, date_to: datetime) -> Iterator[dict]:
     WH_DOC_API_PARAMETERS = {
         "period": "more",
         "date_from": format_date(date_from),
         "date_to": format_date(date_to),
-        "per_page": 500,
-        "api_token": API_TOKEN,
         "kind": "rw",
     }
-    endpoint = WAREHOUSE_DOC_ENDPOINT
-    parameters = WH_DOC_API_PARAMETERS
-    response = requests.get(endpoint, parameters)
-    print(response.json())
-    document_list = response.json()
-    return document_list
+    for page in fakturownia.iter_pages(WAREHOUSE_DOC_ENDPOINT, WH_DOC_API_PARAMETERS):
+        yield from page
 
 
 # get / wh actions
-def get_product_balance(product: Product):
+def get_product_balance(product: Product, warehouse_id: int = PRODUCTS_WAREHOUSE_ID):
     parameters = {
-        "api_token": API_TOKEN,
         "product_id": product.fakturownia_id,
-        "warehouse_id": 6033,
+        "warehouse_id": warehouse_id,
     }
-    response = requests.get(WAREHOUSE_ACTIONS_ENDPOINT, parameters)
-    wh_actions = response.json()
+    wh_actions = fakturownia.get_list(parameters, WAREHOUSE_ACTIONS_ENDPOINT)
     balance = sum([float(action['quantity']) for action in wh_actions])
     return balance
 
 
+# sync / wh actions -> local WarehouseAction ledger
+# incremental syncs list actions from ACTIONS_OVERLAP before the latest synced action's date, so the cost does not
+# grow with history; actions are made equal to the listing within that window, whatever order it comes in.
+# A full sync reconciles the whole ledger, catching edits and deletes of older actions
+def sync_warehouse_actions(warehouse_id: int = PRODUCTS_WAREHOUSE_ID, full: bool = False) -> dict:
+    ledger = WarehouseAction.objects.filter(warehouse_id=warehouse_id)
+    parameters = {"warehouse_id": warehouse_id}
+    date_from = None
+    if not full:
+        latest = ledger.aggregate(Max('date'))['date__max']
+        if latest:
+            date_from = latest - ACTIONS_OVERLAP
+            ledger = ledger.filter(date__gte=date_from)
+            parameters.update({"period": "more", "date_from": format_date(date_from)})
+
+    listed = {}
+    for page in fakturownia.iter_pages(WAREHOUSE_ACTIONS_ENDPOINT, parameters):
+        for action in page:
+            date = datetime.date.fromisoformat(action['created_at'][:10]) if action.get('created_at') else None
+            if date_from and date and date < date_from:
+                continue  # outside the window, the ledger part compared below would not have it
+            listed[action['id']] = (action['product_id'], Decimal(str(action['quantity'])).quantize(Decimal('0.01')),
+                                    date)
+
+    fields = ['product_fakturownia_id', 'quantity', 'date']
+    with transaction.atomic():
+        ledger = {action.fakturownia_id: action for action in ledger}
+        new_actions, changed = [], []
+        for fakturownia_id, values in listed.items():
+            action = ledger.get(fakturownia_id)
+            if action is None:
+                new_actions.append(WarehouseAction(fakturownia_id=fakturownia_id, warehouse_id=warehouse_id,
+                                                   **dict(zip(fields, values))))
+            elif tuple(getattr(action, field) for field in fields) != values:
+                for field, value in zip(fields, values):
+                    setattr(action, field, value)
+                changed.append(action)
+        removed = [fakturownia_id for fakturownia_id in ledger if fakturownia_id not in listed]
+        WarehouseAction.objects.filter(warehouse_id=warehouse_id, fakturownia_id__in=removed).delete()
+        WarehouseAction.objects.bulk_update(changed, fields, batch_size=500)
+        WarehouseAction.objects.bulk_create(new_actions, batch_size=500)
+    return {'created': len(new_actions), 'updated': len(changed), 'deleted': len(removed)}
+
+
+def ledger_balances(product_ids, warehouse_id: int = PRODUCTS_WAREHOUSE_ID) -> dict:
+    rows = WarehouseAction.objects.filter(warehouse_id=warehouse_id, product_fakturownia_id__in=product_ids)\
+        .values('product_fakturownia_id').annotate(balance=Sum('quantity'))
+    return {row['product_fakturownia_id']: row['balance'] for row in rows}
+
+
+class ProductBalances:
+    # per-run cache of product balances keyed by (product fakturownia id, warehouse id), read from the local ledger
+    def __init__(self, warehouse_id: int = PRODUCTS_WAREHOUSE_ID):
+        self.warehouse_id = warehouse_id
+        self.balances = {}
+        self.synced = False
+
+    def key(self, product: Product) -> tuple:
+        return product.fakturownia_id, self.warehouse_id
+
+    def sync(self):
+        if not self.synced:
+            sync_warehouse_actions(self.warehouse_id)
+            self.synced = True
+
+    # load balances of all not yet cached products with a single aggregate query, the ledger is synced
+    # only when some balance is needed
+    def prefetch(self, products):
+        missing = {product.fakturownia_id for product in products if self.key(product) not in self.balances}
+        if not missing:
+            return
+        self.sync()
+        balances = ledger_balances(missing, self.warehouse_id)
+        for product_id in missing:
+            self.balances[(product_id, self.warehouse_id)] = balances.get(product_id, 0)
+
+    def get(self, product: Product):
+        if self.key(product) not in self.balances:
+            self.prefetch([product])
+        return self.balances[self.key(product)]
+
+
 # create / wh_doc (rw)
 def create_fakturownia_rw(rw: RW):
-    headers = {
-        'accept': "application/json",
-        'content-type': "application/json",
-    }
-
     parameters = {
-        "api_token": API_TOKEN,
         'warehouse_document':
             {"kind": "rw",
              "number": rw.number,
@@ -97,34 +322,29 @@ def create_fakturownia_rw(rw: RW):
              }
     }
 
-    response = requests.post(WAREHOUSE_DOC_ENDPOINT, headers=headers, data=json.dumps(parameters))
+    response = fakturownia.post(WAREHOUSE_DOC_ENDPOINT, parameters)
     return response.json()['id']
 
 
 # update / wh_doc (rw)
 def update_fakturownia_rw(rw: RW):
-    headers = {
-        'accept': "application/json",
-        'content-type': "application/json",
-    }
-    endpoint = f"https://marcelipl.fakturownia.pl/warehouse_documents/{str(rw.fakturownia_id)}.json"
+    endpoint = f"warehouse_documents/{str(rw.fakturownia_id)}.json"
 
     parameters = {
-        "api_token": API_TOKEN,
         'warehouse_document': {
             "number": rw.number,
             "issue_date": rw.issue_date
         }
     }
 
-    response = requests.put(endpoint, headers=headers, data=json.dumps(parameters))
+    response = fakturownia.put(endpoint, parameters)
     print(response.json())
 
 
 # get (by id) / wh_doc (rw)
 def get_fakturownia_rw_value(rw: RW):
-    endpoint = f"https://marcelipl.fakturownia.pl/warehouse_documents/{rw.fakturownia_id}.json"
-    response = requests.get(endpoint, {"api_token": API_TOKEN})
+    endpoint = f"warehouse_documents/{rw.fakturownia_id}.json"
+    response = fakturownia.get(endpoint)
     value = 0
     if response.status_code == 404:
         print("RW not found!")
@@ -141,25 +361,30 @@ def get_fakturownia_rw_value(rw: RW):
     return value
 
 
-# create / wh_doc (pw), wh_actions
-def create_fakturownia_pw(doc: ProductionDoc):
+# get (by id) / wh_docs (rws) in parallel, yields (rw, value) as the responses come in
+def request_rw_values(rws: list, max_workers: int = None) -> Iterator[tuple]:
+    if not rws:
+        return
+    with ThreadPoolExecutor(max_workers=min(max_workers or fakturownia.pool_size, len(rws))) as executor:
+        futures = {executor.submit(get_fakturownia_rw_value, rw): rw for rw in rws}
+        for future in as_completed(futures):
+            yield futures[future], future.result()
+
+
+# wh_doc (pw) with wh_actions of produced positions, positions should be prefetched
+def pw_payload(doc: ProductionDoc) -> dict:
     wh_actions = [{"product_id": pos.product.fakturownia_id,
                    "purchase_tax": 0,
                    "price_net": pos.unit_price_float,
                    'purchase_price_net': pos.unit_price_float,
                    "quantity": pos.final_quantity
                    } for pos in doc.produced_positions]
-    headers = {
-        'accept': "application/json",
-        'content-type': "application/json",
-    }
 
-    parameters = {
-        "api_token": API_TOKEN,
+    return {
         'warehouse_document': {
             "kind": "pw",
             "number": doc.number,
-            "warehouse_id": 6033,
+            "warehouse_id": PRODUCTS_WAREHOUSE_ID,
             "issue_date": format_date(doc.first_sale_date),
             'client_id': 1184961,
             'seller_person': 'Michał Chełmiński',
@@ -169,6 +394,24 @@ def create_fakturownia_pw(doc: ProductionDoc):
         }
     }
 
-    response = requests.post(WAREHOUSE_DOC_ENDPOINT, headers=headers, data=json.dumps(parameters))
-    print(response.json())
-    return response.json()['id']
+
+# create / wh_doc (pw), wh_actions; returns the created document
+def create_fakturownia_pw(doc: ProductionDoc, payload: dict = None) -> dict:
+    response = fakturownia.post(WAREHOUSE_DOC_ENDPOINT, payload or pw_payload(doc))
+    response.raise_for_status()
+    document = response.json()
+    print(f"PW {document.get('number')} created for {doc}, id: {document['id']}")
+    return document
+
+
+# create / wh_docs (pw) in parallel, yields (doc, created document or the exception) as the responses come in
+def submit_pws(payloads: list, max_workers: int = None) -> Iterator[tuple]:
+    if not payloads:
+        return
+    with ThreadPoolExecutor(max_workers=min(max_workers or fakturownia.pool_size, len(payloads))) as executor:
+        futures = {executor.submit(create_fakturownia_pw, doc, payload): doc for doc, payload in payloads}
+        for future in as_completed(futures):
+            try:
+                yield futures[future], future.result()
+            except Exception as e:
+                yield futures[future], e
@@ -0,0 +1,478 @@
+import datetime
+import re
+from collections import Counter
+from itertools import islice
+
+from django.db import connection, transaction
+from django.db.models import Q
+from django.db.models.signals import pre_delete, post_delete
+from django.utils.dateparse import parse_datetime
+from .models import Month, Invoice, Product, InvoicePosition, ProductionDoc, ProductionPosition, RW
+from .fakturownia import request_invoices, request_invoices_by_id, request_rws, ProductBalances, \
+    PRODUCTS_WAREHOUSE_ID, PER_PAGE
+from .db import count_queries
+from .signals import PURGE_SAFE_RECEIVERS
+
+
+def updated_at(document: dict) -> datetime.datetime:
+    return parse_datetime(document['updated_at']) if document.get('updated_at') else None
+
+
+def is_changed(document: dict, cursor: datetime.datetime) -> bool:
+    if cursor is None:
+        return True
+    document_updated_at = updated_at(document)
+    return document_updated_at is None or document_updated_at > cursor
+
+
+def latest(cursor: datetime.datetime, document: dict) -> datetime.datetime:
+    document_updated_at = updated_at(document)
+    if cursor is None or (document_updated_at and document_updated_at > cursor):
+        return document_updated_at
+    return cursor
+
+
+def batches(iterable, size: int):
+    iterator = iter(iterable)
+    while batch := list(islice(iterator, size)):
+        yield batch
+
+
+# invoice fields from fakturownia document
+def invoice_fields(document: dict) -> dict:
+    return {
+        'date': datetime.datetime.strptime(document['issue_date'], "%Y-%m-%d"),
+        'number': document['number'],
+        'order_id': document['oid'],
+        'buyer': document['buyer_name'],
+        'warehouse_id': document['warehouse_id'],
+        'value': document['price_net'],
+        'currency': document['currency'],
+        'exchange_rate': document['exchange_rate'],
+    }
+
+
+# field values as they would be written to the db, so fetched strings and floats compare equal to stored values
+def db_values(obj, fields) -> tuple:
+    values = []
+    for name in fields:
+        field = obj._meta.get_field(name)
+        values.append(field.get_db_prep_save(getattr(obj, field.attname), connection))
+    return tuple(values)
+
+
+# set fields on a stored row, tells if anything changed
+def assign(obj, fields: dict) -> bool:
+    before = db_values(obj, fields)
+    for name, value in fields.items():
+        setattr(obj, name, value)
+    return db_values(obj, fields) != before
+
+
+# insert new and update changed rows of a model keyed on a unique field, unchanged rows are not written
+def upsert(model, key: str, rows: dict) -> tuple:
+    objects = model.objects.in_bulk(rows.keys(), field_name=key)
+    created, updated = [], []
+    for value, fields in rows.items():
+        if value not in objects:
+            created.append(model(**{key: value}, **fields))
+        elif assign(objects[value], fields):
+            updated.append(objects[value])
+
+    if created:
+        model.objects.bulk_create(created)
+        objects.update(model.objects.in_bulk([getattr(obj, key) for obj in created], field_name=key))
+        created = [objects[getattr(obj, key)] for obj in created]
+    if updated:
+        model.objects.bulk_update(updated, list(next(iter(rows.values()))))
+    return objects, created, updated
+
+
+def tally(stats: dict, name: str, total: int, created: int, updated: int, deleted: int = None):
+    counts = {'created': created, 'updated': updated, 'unchanged': total - created - updated}
+    if deleted is not None:
+        counts['deleted'] = deleted
+    for outcome, count in counts.items():
+        stats[f"{name} {outcome}"] = stats.get(f"{name} {outcome}", 0) + count
+
+
+# products by fakturownia id, missing ones are created and renamed ones updated
+def product_map(positions: list, stats: dict) -> dict:
+    names = {position['product_id']: {'name': position['name']} for position in positions}
+    products, created, updated = upsert(Product, 'fakturownia_id', names)
+    tally(stats, 'products', len(names), len(created), len(updated))
+    return products
+
+
+INVOICE_POSITION_FIELDS = ['product', 'quantity', 'price', 'total_price']
+
+
+def invoice_position(invoice: Invoice, products: dict, position: dict) -> InvoicePosition:
+    # calculate discount
+    discount = position['discount']
+    if discount is None:
+        discount = 0
+    else:
+        discount = float(discount)
+
+    return InvoicePosition(
+        product=products[position['product_id']],
+        invoice=invoice,
+        quantity=position['quantity'],
+        price=position['price_net'],
+        total_price=float(position['total_price_net']) - discount,
+    )
+
+
+# upsert a batch of invoices, positions of an invoice are replaced only when they differ from the stored ones
+def upsert_invoices(month: Month, documents: list, stats: dict):
+    products = product_map([position for document in documents for position in document['positions']], stats)
+    invoices, created, updated = upsert(Invoice, 'fakturownia_id', {
+        document['id']: {'month': month, **invoice_fields(document)} for document in documents
+    })
+    tally(stats, 'invoices', len(documents), len(created), len(updated))
+
+    stored = {}
+    new_invoices = {invoice.fakturownia_id for invoice in created}
+    for position in InvoicePosition.objects.filter(invoice__in=[invoices[document['id']] for document in documents
+                                                                if document['id'] not in new_invoices]):
+        stored.setdefault(position.invoice_id, []).append(position)
+
+    new_positions, replaced, unchanged = [], [], 0
+    for document in documents:
+        invoice = invoices[document['id']]
+        positions = [invoice_position(invoice, products, position) for position in document['positions']]
+        old_positions = stored.get(invoice.id, [])
+        if Counter(db_values(position, INVOICE_POSITION_FIELDS) for position in positions) == \
+                Counter(db_values(position, INVOICE_POSITION_FIELDS) for position in old_positions):
+            unchanged += len(positions)
+            continue
+        new_positions.extend(positions)
+        replaced.extend(position.id for position in old_positions)
+
+    delete_rows(InvoicePosition.objects.filter(id__in=replaced))
+    InvoicePosition.objects.bulk_create(new_positions)
+    tally(stats, 'invoice positions', len(new_positions) + unchanged, len(new_positions), 0, len(replaced))
+
+
+# create production docs and positions for sales from product warehouse, optionally only for given orders;
+# balances should have their ledger synced already when called in a transaction
+def build_production_docs(month: Month, stats: dict, order_numbers: set = None, balances: ProductBalances = None):
+    invoice_positions = InvoicePosition.objects.filter(invoice__month=month,
+                                                       invoice__warehouse_id=PRODUCTS_WAREHOUSE_ID)
+    docs = ProductionDoc.objects.filter(month=month)
+    if order_numbers is not None:
+        invoice_positions = invoice_positions.filter(invoice__order_id__in=order_numbers)
+        docs = docs.filter(order_number__in=order_numbers)
+    invoice_positions = list(invoice_positions.select_related('invoice', 'product').order_by('invoice_id', 'id'))
+
+    # production docs by order number, in order of first invoice
+    orders = list(dict.fromkeys(position.invoice.order_id for position in invoice_positions))
+    docs = {doc.order_number: doc for doc in docs}
+    new_docs = [ProductionDoc(month=month, order_number=order) for order in orders if order not in docs]
+    ProductionDoc.objects.bulk_create(new_docs)
+    docs = {doc.order_number: doc for doc in ProductionDoc.objects.filter(month=month, order_number__in=orders)}
+
+    # production positions by (doc, product)
+    keys = dict.fromkeys((docs[position.invoice.order_id].id, position.product_id) for position in invoice_positions)
+    production_positions = {(position.production_doc_id, position.product_id): position for position in
+                            ProductionPosition.objects.filter(production_doc__in=docs.values()).select_related('product')}
+    new_positions = [ProductionPosition(production_doc_id=doc_id, product_id=product_id)
+                     for doc_id, product_id in keys if (doc_id, product_id) not in production_positions]
+    if new_positions:
+        ProductionPosition.objects.bulk_create(new_positions)
+        production_positions = {(position.production_doc_id, position.product_id): position for position in
+                                ProductionPosition.objects.filter(production_doc__in=docs.values())
+                                .select_related('product')}
+
+    # connect invoice positions with production positions
+    sales, relinked = {}, []
+    for position in invoice_positions:
+        production_position = production_positions[(docs[position.invoice.order_id].id, position.product_id)]
+        if position.production_position_id != production_position.id:
+            relinked.append(position)
+        position.production_position = production_position
+        sales.setdefault(production_position.id, []).append(position)
+    InvoicePosition.objects.bulk_update(relinked, ['production_position'])
+    # positions of invoices moved out of the product warehouse are not sold production anymore
+    moved = InvoicePosition.objects.filter(invoice__month=month, production_position__isnull=False)\
+        .exclude(invoice__warehouse_id=PRODUCTS_WAREHOUSE_ID)
+    if order_numbers is not None:
+        moved = moved.filter(invoice__order_id__in=order_numbers)
+    moved = list(moved.values_list('id', flat=True))
+    if moved:
+        InvoicePosition.objects.filter(id__in=moved).update(production_position=None)
+
+    # balances of sold products, one aggregate query
+    linked = [production_positions[key] for key in keys]
+    balances = balances or ProductBalances(PRODUCTS_WAREHOUSE_ID)
+    balances.prefetch(position.product for position in linked)
+    position_fields = ['balance', 'do_not_produce'] + ProductionPosition.SALES_FIELDS
+    changed_positions = []
+    for position in linked:
+        before = db_values(position, position_fields)
+        position.balance = balances.get(position.product)
+        position.set_do_not_produce(save=False)
+        position.set_sales(sales[position.id])
+        if db_values(position, position_fields) != before:
+            changed_positions.append(position)
+    ProductionPosition.objects.bulk_update(changed_positions, position_fields)
+
+    # positions and docs left without sales; invoice positions still linked to them (e.g. of an invoice moved
+    # out of the product warehouse) are unlinked first, the delete would cascade to them
+    stale_positions = [position.id for key, position in production_positions.items() if key not in keys]
+    stale_docs = ProductionDoc.objects.filter(month=month).exclude(order_number__in=orders)
+    if order_numbers is not None:
+        stale_docs = stale_docs.filter(order_number__in=order_numbers)
+    stale_docs = list(stale_docs.values_list('id', flat=True))
+    InvoicePosition.objects.filter(Q(production_position_id__in=stale_positions) |
+                                   Q(production_position__production_doc_id__in=stale_docs))\
+        .update(production_position=None)
+    ProductionPosition.objects.filter(id__in=stale_positions).delete()
+    ProductionDoc.objects.filter(id__in=stale_docs).delete()
+
+    doc_fields = ['do_not_produce'] + ProductionDoc.SALES_FIELDS
+    changed_docs = []
+    for doc in docs.values():
+        before = db_values(doc, doc_fields)
+        positions = [position for position in linked if position.production_doc_id == doc.id]
+        doc.do_not_produce = all(position.do_not_produce for position in positions)
+        doc.set_sales(positions)
+        if db_values(doc, doc_fields) != before:
+            changed_docs.append(doc)
+    ProductionDoc.objects.bulk_update(changed_docs, doc_fields)
+
+    # new rows are counted as created even though their fields are filled in afterwards
+    created_docs = {doc.order_number for doc in new_docs}
+    created_positions = {(position.production_doc_id, position.product_id) for position in new_positions}
+    tally(stats, 'production docs', len(docs), len(created_docs),
+          len([doc for doc in changed_docs if doc.order_number not in created_docs]), len(stale_docs))
+    tally(stats, 'production positions', len(linked), len(created_positions),
+          len([position for position in changed_positions
+               if (position.production_doc_id, position.product_id) not in created_positions]), len(stale_positions))
+
+
+# order numbers as they appear in rw descriptions, e.g. "Wydanie surowców do 123/22 ..."
+ORDER_NUMBER = re.compile(r"\d+/\d+")
+
+
+class OrderIndex:
+    # production docs by order number; when a description has no well-formed order number, all order
+    # numbers are searched at once with a single alternation pattern, longest first; docs without an order
+    # number are left out, an empty alternative would match any description
+    def __init__(self, docs):
+        self.docs = {}
+        for doc in docs:
+            if doc.order_number and doc.order_number.strip():
+                self.docs.setdefault(doc.order_number, doc)
+        self.pattern = None
+        if self.docs:
+            self.pattern = re.compile("|".join(re.escape(order_number) for order_number in
+                                               sorted(self.docs, key=len, reverse=True)))
+
+    def match(self, description: str):
+        description = description or ""
+        for order_number in ORDER_NUMBER.findall(description):
+            if order_number in self.docs:
+                return self.docs[order_number]
+        if self.pattern:
+            found = self.pattern.search(description)
+            if found:
+                return self.docs[found.group()]
+        return None
+
+
+# link rws to production docs by order number in rw description
+def link_rws(month: Month, rws) -> int:
+    docs = list(month.productiondoc_set.order_by('first_sale_date', 'id'))
+    stored = {doc.id: doc.rw_id for doc in docs}
+    index = OrderIndex(docs)
+    for r in rws:
+        doc = index.match(r.description)
+        if doc is not None:
+            doc.rw = r
+    linked = [doc for doc in docs if doc.rw_id != stored[doc.id]]
+    ProductionDoc.objects.bulk_update(linked, ['rw'])
+    return len(linked)
+
+
+def rw_fields(rw: dict) -> dict:
+    return {
+        'number': rw['number'],
+        'issue_date': rw['issue_date'],
+        'description': rw['description'],
+    }
+
+
+# upsert rws of a month, returns created and updated ones
+def upsert_rws(month: Month, rws: list, stats: dict) -> list:
+    _, created, updated = upsert(RW, 'fakturownia_id', {rw['id']: {'month': month, **rw_fields(rw)} for rw in rws})
+    tally(stats, 'rws', len(rws), len(created), len(updated))
+    return created + updated
+
+
+# full import of a month, safe to re-run: rows are upserted on fakturownia ids and natural keys
+# progress, if given, is called with the number of invoices saved so far
+def import_month(month: Month, progress=None) -> dict:
+    stats = {}
+    cursor = None
+
+    with count_queries() as queries:
+        # stream invoices from fakturownia for given month, each page saved in its own transaction so progress
+        # is visible while the import runs; upserts make a stopped import safe to run again, and without
+        # a cursor the month is not synced incrementally until an import finishes
+        month.sync_cursor = None
+        month.save(update_fields=['sync_cursor'])
+        listed = set()
+        for documents in batches(request_invoices(month.date_from, month.date_to), PER_PAGE):
+            with transaction.atomic():
+                upsert_invoices(month, documents, stats)
+            for document in documents:
+                listed.add(document['id'])
+                cursor = latest(cursor, document)
+            if progress:
+                progress(len(listed))
+
+        # downloads happen before the transaction, sqlite's write lock is held only while writing
+        print(" about to request RWS")
+        rws = list(request_rws(month.date_from, month.date_to))
+        balances = ProductBalances(PRODUCTS_WAREHOUSE_ID)
+        balances.sync()
+
+        # the rest is written at once, the month's cursor last
+        with transaction.atomic():
+            import_month_documents(month, listed, cursor, rws, balances, stats)
+
+    stats['queries'] = queries.count
+    print(f"Imported {month}: {stats}")
+    return stats
+
+
+# invoices removed from fakturownia, production docs and rws of an imported month
+def import_month_documents(month: Month, listed: set, cursor: datetime.datetime, rws: list,
+                           balances: ProductBalances, stats: dict):
+    # invoices no longer in fakturownia
+    stats['invoices deleted'] = delete_invoices(month.invoice_set.exclude(fakturownia_id__in=listed))
+
+    build_production_docs(month, stats, balances=balances)
+
+    for rw in rws:
+        cursor = latest(cursor, rw)
+    upsert_rws(month, rws, stats)
+    stats['rws linked'] = link_rws(month, RW.objects.filter(month=month))
+
+    month.sync_cursor = cursor
+    month.save()
+
+
+# incremental sync of a month, only new or changed documents are downloaded in full and upserted;
+# progress, if given, is called with the number of changed invoices downloaded so far and their count
+def sync_month(month: Month, progress=None) -> dict:
+    # a month never imported, or with an unfinished import, would download every invoice one by one
+    if month.sync_cursor is None:
+        print(f"{month} has no sync cursor, importing it in full")
+        return import_month(month, progress)
+    cursor = month.sync_cursor
+    new_cursor = cursor
+    known = dict(month.invoice_set.values_list('fakturownia_id', 'order_id'))
+    stats = {}
+
+    with count_queries() as queries:
+        # listing without positions, invoices changed since last sync are downloaded in full below
+        listed, changed = set(), []
+        for document in request_invoices(month.date_from, month.date_to, include_positions=False):
+            listed.add(document['id'])
+            if document['id'] not in known or is_changed(document, cursor):
+                changed.append(document['id'])
+            new_cursor = latest(new_cursor, document)
+        if progress:
+            progress(0, len(changed))
+
+        # changed invoices are downloaded before anything is written, so the sync is one transaction and
+        # its progress is visible meanwhile
+        downloaded = []
+        for documents in batches(request_invoices_by_id(changed), PER_PAGE):
+            downloaded.append(documents)
+            if progress:
+                progress(sum(len(documents) for documents in downloaded))
+
+        # as in import_month, nothing is downloaded once the transaction is open
+        rws = list(request_rws(month.date_from, month.date_to))
+        removed = set(known) - listed
+        balances = ProductBalances(PRODUCTS_WAREHOUSE_ID)
+        if removed or changed:
+            balances.sync()
+
+        with transaction.atomic():
+            # changed invoices are upserted with their positions, removed ones deleted
+            affected_orders = {known[fakturownia_id] for fakturownia_id in removed | set(changed)
+                               if fakturownia_id in known}
+            stats['invoices deleted'] = delete_invoices(Invoice.objects.filter(fakturownia_id__in=removed))
+            for documents in downloaded:
+                upsert_invoices(month, documents, stats)
+                affected_orders.update(document['oid'] for document in documents)
+
+            # rebuild production docs of affected orders only
+            build_production_docs(month, stats, affected_orders, balances)
+            stats['orders rebuilt'] = len(affected_orders)
+
+            for rw in rws:
+                new_cursor = latest(new_cursor, rw)
+            changed_rws = upsert_rws(month, rws, stats)
+            link_rws(month, RW.objects.filter(month=month).filter(Q(id__in=[rw.id for rw in changed_rws]) |
+                                                                 Q(productiondoc=None)))
+
+            month.sync_cursor = new_cursor
+            month.save()
+
+    stats['queries'] = queries.count
+    print(f"Synced {month}: {stats}")
+    return stats
+
+
+# deletes through the collector are needed only when a delete receiver has to see the rows
+def needs_collector(model) -> bool:
+    for signal in (pre_delete, post_delete):
+        for (receiver_key, sender_key), *_ in signal.receivers:
+            if sender_key in (id(model), id(None)) and receiver_key not in PURGE_SAFE_RECEIVERS:
+                return True
+    return False
+
+
+# set-based delete of a queryset, through the collector only when needed; cascades are not followed,
+# so children have to be deleted first; returns the number of deleted rows
+def delete_rows(queryset) -> int:
+    if needs_collector(queryset.model):
+        return queryset.delete()[1].get(queryset.model._meta.label, 0)
+    return queryset._raw_delete(queryset.db)
+
+
+# delete invoices along with their positions; production docs of their orders are rebuilt afterwards,
+# so the per row refresh of the delete receiver is not needed
+def delete_invoices(invoices) -> int:
+    delete_rows(InvoicePosition.objects.filter(invoice__in=invoices))
+    return delete_rows(invoices)
+
+
+# delete all documents of a month with set-based deletes, children first, returns deleted rows per table
+def purge_month(month: Month) -> dict:
+    tables = [
+        (InvoicePosition, InvoicePosition.objects.filter(Q(invoice__month=month) |
+                                                         Q(production_position__production_doc__month=month))),
+        (ProductionPosition, ProductionPosition.objects.filter(production_doc__month=month)),
+        (ProductionDoc, ProductionDoc.objects.filter(month=month)),
+        (Invoice, Invoice.objects.filter(month=month)),
+        (RW, RW.objects.filter(month=month)),
+    ]
+    stats = {}
+    with count_queries() as queries, transaction.atomic():
+        # rws of the month linked from docs of other months, as on_delete=SET_NULL would do
+        ProductionDoc.objects.filter(rw__month=month).exclude(month=month).update(rw=None)
+        for model, queryset in tables:
+            stats[model._meta.model_name] = delete_rows(queryset)
+        month.sync_cursor = None
+        month.save()
+
+    stats['queries'] = queries.count
+    print(f"Purged {month}: {stats}")
+    return stats
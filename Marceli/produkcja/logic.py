@@ -1,32 +1,43 @@
-from .models import ProductionDoc, RW
-from .odoo import Odoo
+from .models import Month, ProductionDoc, ProductionPosition, RW
+from .odoo import odoo
+from django.db.models import F, Window
+from django.db.models.functions import RowNumber
+from decimal import Decimal, ROUND_FLOOR, ROUND_HALF_UP
 import datetime
 
-odoo = Odoo()
-
 def format_date(date: datetime.date) -> str:
     return date.strftime("%Y-%m-%d")
 
 
-def generate_rw_numbers_dates(docs: list[ProductionDoc]):
-    for n, doc in enumerate(docs):
-        year = str(doc.month.year)[2:]
-        month = str(doc.month.month).zfill(2)
-        num = str(n+1).zfill(2)
-        doc.number = f"{year}/{month}/{num}"
+# number produced docs of a month in order of first sale and set rw dates, numbers come from a window function
+def generate_rw_numbers_dates(month: Month):
+    docs = list(month.productiondoc_set.filter(do_not_produce=False).select_related('rw')
+                .annotate(sequence=Window(RowNumber(), order_by=[F('first_sale_date').asc(), F('id').asc()]))
+                .order_by('sequence'))
+    year = str(month.year)[2:]
+    month_number = str(month.month).zfill(2)
+
+    rws = []
+    for doc in docs:
+        doc.number = f"{year}/{month_number}/{str(doc.sequence).zfill(2)}"
 
         sale_date = doc.first_sale_date
-        if sale_date.day > 7:
+        if sale_date is None:
+            doc.rw_date = None
+        elif sale_date.day > 7:
             doc.rw_date = sale_date - datetime.timedelta(days=7)
         else:
             doc.rw_date = sale_date.replace(day=1)
-        doc.save()
 
         if doc.rw:
-            rw = doc.rw
-            rw.number = doc.number
-            rw.issue_date = format_date(doc.rw_date)
-            rw.save()
+            doc.rw.number = doc.number
+            if doc.rw_date:
+                doc.rw.issue_date = format_date(doc.rw_date)
+            rws.append(doc.rw)
+
+    ProductionDoc.objects.bulk_update(docs, ['number', 'rw_date'], batch_size=500)
+    RW.objects.bulk_update(rws, ['number', 'issue_date'], batch_size=500)
+    return docs
 
 
 def create_new_django_rw(doc: ProductionDoc):
@@ -40,18 +51,49 @@ def create_new_django_rw(doc: ProductionDoc):
     doc.save()
 
 
-def assign_raw_materials_to_positions(doc: ProductionDoc):
-    value_left = doc.rw.value
-    positions = doc.produced_positions
-    if value_left and positions:
-        last_position = positions[-1]
-        for position in positions:
-            if position == last_position:
-                value = value_left
-            else:
-                value = round(float(position.sales_fraction) * float(doc.rw.value), 2)
-                value_left -= value
-                position.raw_materials_value = value
-                position.save()
-            if value:
-                odoo.update_position(position, {'x_studio_raw_materials_value': value})
+# split amount into parts proportional to weights, in whole cents; shares are rounded down and the cents
+# left go to the parts with the largest remainders, so the parts always sum to amount exactly, also when
+# some weights are negative
+def allocate(amount: Decimal, weights: list) -> list:
+    cents = int((abs(amount) * 100).to_integral_value(ROUND_HALF_UP))
+    sign = -1 if amount < 0 else 1
+    weights = [Decimal(str(weight)) for weight in weights]
+    total = sum(weights, Decimal(0))
+    if not weights:
+        return []
+    if not total:
+        # no sales value to split by, everything goes to the last position
+        weights = [Decimal(0)] * (len(weights) - 1) + [Decimal(1)]
+        total = Decimal(1)
+
+    shares = [cents * weight / total for weight in weights]
+    parts = [int(share.to_integral_value(ROUND_FLOOR)) for share in shares]
+    by_remainder = sorted(range(len(shares)), key=lambda i: shares[i] - parts[i], reverse=True)
+    for i in by_remainder[:cents - sum(parts)]:
+        parts[i] += 1
+    return [sign * Decimal(part) / 100 for part in parts]
+
+
+# split rw values of all produced docs of a month over their produced positions by sales value
+def assign_raw_materials(month: Month) -> list:
+    docs = list(month.productiondoc_set.filter(do_not_produce=False).exclude(rw=None).select_related('rw'))
+    positions = {}
+    for position in ProductionPosition.objects.filter(production_doc__in=docs, do_not_produce=False)\
+            .select_related('product').order_by('id'):
+        positions.setdefault(position.production_doc_id, []).append(position)
+
+    allocated = []
+    for doc in docs:
+        doc_positions = positions.get(doc.id, [])
+        if not doc.rw.value or not doc_positions:
+            continue
+        values = allocate(doc.rw.value, [position.value_pln for position in doc_positions])
+        for position, value in zip(doc_positions, values):
+            position.raw_materials_value = value
+            allocated.append(position)
+
+    ProductionPosition.objects.bulk_update(allocated, ['raw_materials_value'], batch_size=500)
+    for position in allocated:
+        if position.raw_materials_value and position.odoo_id is not None:
+            odoo.update_position(position, {'x_studio_raw_materials_value': float(position.raw_materials_value)})
+    return allocated
@@ -0,0 +1,143 @@
+import random
+import time
+from datetime import date
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.db.migrations.executor import MigrationExecutor
+
+BEFORE = ('produkcja', '0022_sales_columns')
+AFTER = ('produkcja', '0023_lookup_indexes')
+WAREHOUSES = [6032, 6033]
+
+
+class Command(BaseCommand):
+    help = "Times the pipeline's lookups on a synthetic multi-year dataset in a throwaway test database, " \
+           "before and after the lookup indexes migration"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--years', type=int, default=3)
+        parser.add_argument('--orders', type=int, default=300, help="production docs per month")
+        parser.add_argument('--positions', type=int, default=4, help="positions per production doc")
+        parser.add_argument('--lookups', type=int, default=2000)
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        old_name = connection.settings_dict['NAME']
+        # the benchmark moves between migrations itself, so the test database has to start migrated
+        test_settings = connection.settings_dict['TEST']
+        migrate, test_settings['MIGRATE'] = test_settings.get('MIGRATE', True), True
+        connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        try:
+            self.run(options)
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            test_settings['MIGRATE'] = migrate
+
+    def migrate(self, target):
+        executor = MigrationExecutor(connection)
+        executor.migrate([target])
+        # historical models match the tables as they are at this migration
+        return executor.loader.project_state(target).apps
+
+    def run(self, options):
+        self.verbosity = options['verbosity']
+        apps = self.migrate(BEFORE)
+        rng = random.Random(options['seed'])
+        dataset = self.fill(apps, rng, options)
+        self.stdout.write(f"dataset: {dataset['months']} months, {dataset['docs']} production docs, "
+                          f"{dataset['positions']} positions, {dataset['invoices']} invoices")
+
+        before = self.time_lookups(apps, random.Random(options['seed']), options['lookups'])
+        apps = self.migrate(AFTER)
+        after = self.time_lookups(apps, random.Random(options['seed']), options['lookups'])
+
+        self.stdout.write(f"{'lookup':<32}{'before ms':>12}{'after ms':>12}{'speedup':>10}")
+        for name in before:
+            self.stdout.write(f"{name:<32}{before[name] * 1000:>12.1f}{after[name] * 1000:>12.1f}"
+                              f"{before[name] / after[name]:>9.1f}x")
+
+    def fill(self, apps, rng, options):
+        Month = apps.get_model('produkcja', 'Month')
+        Product = apps.get_model('produkcja', 'Product')
+        Invoice = apps.get_model('produkcja', 'Invoice')
+        ProductionDoc = apps.get_model('produkcja', 'ProductionDoc')
+        ProductionPosition = apps.get_model('produkcja', 'ProductionPosition')
+
+        Product.objects.bulk_create([Product(name=f"product {i}", fakturownia_id=i) for i in range(1, 201)])
+        products = list(Product.objects.values_list('id', flat=True))
+
+        Month.objects.bulk_create([Month(year=2020 + i // 12, month=i % 12 + 1) for i in range(options['years'] * 12)])
+        months = list(Month.objects.all())
+
+        invoice_id = 0
+        for month in months:
+            docs, invoices = [], []
+            for order in range(options['orders']):
+                order_number = f"{month.month:02d}{order:06d}"
+                docs.append(ProductionDoc(month=month, order_number=order_number))
+                invoice_id += 1
+                invoices.append(Invoice(
+                    fakturownia_id=invoice_id, month=month, date=date(month.year, month.month, rng.randint(1, 28)),
+                    number=f"FV/{invoice_id}", order_id=order_number, buyer="buyer",
+                    warehouse_id=rng.choice(WAREHOUSES), value=100, currency="PLN", exchange_rate=1,
+                ))
+            ProductionDoc.objects.bulk_create(docs, batch_size=500)
+            Invoice.objects.bulk_create(invoices, batch_size=500)
+
+        positions = []
+        for doc_id in ProductionDoc.objects.values_list('id', flat=True):
+            for product_id in rng.sample(products, options['positions']):
+                positions.append(ProductionPosition(production_doc_id=doc_id, product_id=product_id))
+        ProductionPosition.objects.bulk_create(positions, batch_size=500)
+
+        return {
+            'months': len(months),
+            'docs': ProductionDoc.objects.count(),
+            'positions': len(positions),
+            'invoices': Invoice.objects.count(),
+        }
+
+    # the lookups import and month pages issue, same random sample before and after; timed as raw cursor
+    # executions of the ORM's sql so python overhead does not hide the database's cost
+    def time_lookups(self, apps, rng, lookups):
+        Invoice = apps.get_model('produkcja', 'Invoice')
+        ProductionDoc = apps.get_model('produkcja', 'ProductionDoc')
+        ProductionPosition = apps.get_model('produkcja', 'ProductionPosition')
+
+        docs = list(ProductionDoc.objects.values_list('month_id', 'order_number'))
+        positions = list(ProductionPosition.objects.values_list('production_doc_id', 'product_id'))
+        months = sorted({month_id for month_id, _ in docs})
+        doc_sample = [rng.choice(docs) for _ in range(lookups)]
+        position_sample = [rng.choice(positions) for _ in range(lookups)]
+        month_sample = [(rng.choice(months),) for _ in range(lookups // 10)]
+
+        queries = {
+            'doc by (month, order)': (
+                lambda month_id, order_number: ProductionDoc.objects.filter(month_id=month_id,
+                                                                            order_number=order_number),
+                doc_sample),
+            'position by (doc, product)': (
+                lambda doc_id, product_id: ProductionPosition.objects.filter(production_doc_id=doc_id,
+                                                                             product_id=product_id),
+                position_sample),
+            'invoices by (month, warehouse)': (
+                lambda month_id: Invoice.objects.filter(month_id=month_id, warehouse_id=6033).values_list('id'),
+                month_sample),
+            'month invoices by date': (
+                lambda month_id: Invoice.objects.filter(month_id=month_id).order_by('date').values_list('id')[:100],
+                month_sample),
+        }
+
+        timings = {}
+        with connection.cursor() as cursor:
+            for name, (query, sample) in queries.items():
+                statements = [query(*args).query.sql_with_params() for args in sample]
+                start = time.perf_counter()
+                for sql, params in statements:
+                    cursor.execute(sql, params)
+                    cursor.fetchall()
+                timings[name] = time.perf_counter() - start
+                if self.verbosity > 1:
+                    self.stdout.write(f"{name}: {query(*sample[0]).explain()}")
+        return timings
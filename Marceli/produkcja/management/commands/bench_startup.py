@@ -0,0 +1,59 @@
+import json
+import subprocess
+import sys
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+# runs in a fresh interpreter: counts outgoing connections while django starts and `check` runs
+STARTUP_SCRIPT = """
+import json, os, socket, sys, time
+
+connections = []
+create_connection = socket.create_connection
+connect = socket.socket.connect
+
+def record_create_connection(address, *args, **kwargs):
+    connections.append(str(address))
+    return create_connection(address, *args, **kwargs)
+
+def record_connect(self, address):
+    if self.family != socket.AF_UNIX:
+        connections.append(str(address))
+    return connect(self, address)
+
+socket.create_connection = record_create_connection
+socket.socket.connect = record_connect
+
+start = time.perf_counter()
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'Marceli.settings')
+import django
+from django.core.management import call_command
+django.setup()
+call_command('check', verbosity=0)
+import produkcja.views, produkcja.logic, produkcja.fakturownia, produkcja.odoo
+print(json.dumps({'seconds': time.perf_counter() - start, 'connections': connections}))
+"""
+
+
+class Command(BaseCommand):
+    help = "Measures `manage.py check` startup in a fresh process and fails if it opens any network connection"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--runs', type=int, default=5)
+
+    def handle(self, *args, **options):
+        timings = []
+        for _ in range(options['runs']):
+            result = subprocess.run([sys.executable, '-c', STARTUP_SCRIPT], cwd=settings.BASE_DIR,
+                                    capture_output=True, text=True)
+            if result.returncode:
+                raise CommandError(result.stderr)
+            run = json.loads(result.stdout.strip().splitlines()[-1])
+            if run['connections']:
+                raise CommandError(f"startup opened network connections: {run['connections']}")
+            timings.append(run['seconds'])
+
+        self.stdout.write(f"check startup over {len(timings)} runs: "
+                          f"min {min(timings) * 1000:.0f} ms, max {max(timings) * 1000:.0f} ms, "
+                          f"0 network connections")
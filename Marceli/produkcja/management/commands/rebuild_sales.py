@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+from produkcja.models import Month, ProductionDoc, ProductionPosition
+
+
+class Command(BaseCommand):
+    help = "Recomputes stored sales columns of production positions and docs from invoice positions"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--month', type=int, help="id of a single month to rebuild")
+
+    def handle(self, *args, **options):
+        months = Month.objects.all()
+        if options['month']:
+            months = months.filter(pk=options['month'])
+
+        # month by month, so memory is bound by the biggest month
+        for month in months:
+            positions = ProductionPosition.objects.filter(production_doc__month=month).refresh_sales()
+            docs = ProductionDoc.objects.filter(month=month).refresh_sales()
+            self.stdout.write(f"{month}: {len(docs)} production docs, {len(positions)} positions rebuilt")
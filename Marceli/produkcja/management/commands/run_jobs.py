@@ -0,0 +1,29 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+from produkcja.models import Job
+from produkcja.pipeline import run_pending_jobs
+
+
+class Command(BaseCommand):
+    help = "Runs queued month pipeline jobs, polling the database for new ones"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help="run the queued jobs and exit")
+        parser.add_argument('--interval', type=float, default=2.0, help="seconds between polls of an empty queue")
+        parser.add_argument('--requeue-running', action='store_true',
+                            help="queue again jobs left running by a worker that died, use with a single worker")
+
+    def handle(self, *args, **options):
+        if options['requeue_running']:
+            requeued = Job.objects.filter(status=Job.RUNNING).update(status=Job.QUEUED, started_at=None)
+            self.stdout.write(f"requeued {requeued} jobs")
+
+        while True:
+            count = run_pending_jobs()
+            if options['once']:
+                self.stdout.write(f"ran {count} jobs")
+                return
+            close_old_connections()
+            time.sleep(options['interval'])
@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+from produkcja.fakturownia import sync_warehouse_actions, PRODUCTS_WAREHOUSE_ID
+
+
+class Command(BaseCommand):
+    help = "Syncs the local warehouse action ledger from Fakturownia; with --full the whole ledger is reconciled, " \
+           "catching edited and deleted older actions - meant to run nightly, e.g. from cron"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--full', action='store_true')
+        parser.add_argument('--warehouse', type=int, default=PRODUCTS_WAREHOUSE_ID)
+
+    def handle(self, *args, **options):
+        stats = sync_warehouse_actions(options['warehouse'], full=options['full'])
+        self.stdout.write(f"Warehouse {options['warehouse']} actions: {stats}")
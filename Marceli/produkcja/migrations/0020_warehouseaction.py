@@ -0,0 +1,27 @@
+# Generated by Django 4.0.1 on 2022-02-03 10:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('produkcja', '0019_productionposition_do_not_produce_and_more'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='WarehouseAction',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('fakturownia_id', models.IntegerField(unique=True)),
+                ('product_fakturownia_id', models.IntegerField(null=True)),
+                ('warehouse_id', models.IntegerField()),
+                ('quantity', models.DecimalField(decimal_places=2, max_digits=15)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='warehouseaction',
+            index=models.Index(fields=['warehouse_id', 'product_fakturownia_id'], name='wh_action_balance_idx'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.0.1 on 2022-02-04 09:41
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('produkcja', '0020_warehouseaction'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='month',
+            name='sync_cursor',
+            field=models.DateTimeField(null=True),
+        ),
+    ]
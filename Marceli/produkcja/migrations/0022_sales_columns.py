@@ -0,0 +1,95 @@
+# Generated by Django 4.0.1 on 2022-02-07 15:20
+
+from decimal import Decimal
+
+from django.db import migrations, models
+
+
+def fill_sales_columns(apps, schema_editor):
+    ProductionPosition = apps.get_model('produkcja', 'ProductionPosition')
+    ProductionDoc = apps.get_model('produkcja', 'ProductionDoc')
+    InvoicePosition = apps.get_model('produkcja', 'InvoicePosition')
+
+    invoice_positions = {}
+    for invoice_position in InvoicePosition.objects.exclude(production_position=None)\
+            .select_related('invoice').order_by('id'):
+        invoice_positions.setdefault(invoice_position.production_position_id, []).append(invoice_position)
+
+    positions = list(ProductionPosition.objects.order_by('id'))
+    for position in positions:
+        sales = invoice_positions.get(position.id, [])
+        position.quantity = sum((pos.quantity for pos in sales), Decimal(0))
+        position.sales_value = sum((pos.total_price or 0 for pos in sales), Decimal(0))
+        position.value_pln = sum(((pos.total_price or 0) * pos.invoice.exchange_rate for pos in sales), Decimal(0))
+        position.first_sale_date = min((pos.invoice.date for pos in sales), default=None)
+        position.currency = sales[0].invoice.currency if sales else None
+        position.exchange_rate = sales[0].invoice.exchange_rate if sales else 1
+    ProductionPosition.objects.bulk_update(positions, ['quantity', 'sales_value', 'value_pln', 'first_sale_date',
+                                                       'currency', 'exchange_rate'], batch_size=500)
+
+    doc_positions = {}
+    for position in positions:
+        doc_positions.setdefault(position.production_doc_id, []).append(position)
+    docs = list(ProductionDoc.objects.all())
+    for doc in docs:
+        positions = doc_positions.get(doc.id, [])
+        doc.first_sale_date = min((pos.first_sale_date for pos in positions if pos.first_sale_date), default=None)
+        doc.sale_value = sum((pos.value_pln for pos in positions if not pos.do_not_produce), Decimal(0))
+        doc.currency = positions[0].currency if positions else None
+    ProductionDoc.objects.bulk_update(docs, ['first_sale_date', 'sale_value', 'currency'], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('produkcja', '0021_month_sync_cursor'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='productiondoc',
+            name='currency',
+            field=models.CharField(max_length=3, null=True),
+        ),
+        migrations.AddField(
+            model_name='productiondoc',
+            name='first_sale_date',
+            field=models.DateField(null=True),
+        ),
+        migrations.AddField(
+            model_name='productiondoc',
+            name='sale_value',
+            field=models.DecimalField(decimal_places=6, default=0, max_digits=20),
+        ),
+        migrations.AddField(
+            model_name='productionposition',
+            name='currency',
+            field=models.CharField(max_length=3, null=True),
+        ),
+        migrations.AddField(
+            model_name='productionposition',
+            name='exchange_rate',
+            field=models.DecimalField(decimal_places=4, default=1, max_digits=8),
+        ),
+        migrations.AddField(
+            model_name='productionposition',
+            name='first_sale_date',
+            field=models.DateField(null=True),
+        ),
+        migrations.AddField(
+            model_name='productionposition',
+            name='quantity',
+            field=models.DecimalField(decimal_places=2, default=0, max_digits=15),
+        ),
+        migrations.AddField(
+            model_name='productionposition',
+            name='sales_value',
+            field=models.DecimalField(decimal_places=2, default=0, max_digits=15),
+        ),
+        migrations.AddField(
+            model_name='productionposition',
+            name='value_pln',
+            field=models.DecimalField(decimal_places=6, default=0, max_digits=20),
+        ),
+        migrations.RunPython(fill_sales_columns, migrations.RunPython.noop),
+    ]
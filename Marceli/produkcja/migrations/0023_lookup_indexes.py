@@ -0,0 +1,58 @@
+# Generated by Django 4.0.1 on 2022-02-08 11:05
+
+from django.db import migrations, models
+from django.db.models import Count, Min
+
+
+# rows duplicated before the unique constraints existed are merged into the oldest one
+def merge_duplicates(apps, schema_editor):
+    ProductionDoc = apps.get_model('produkcja', 'ProductionDoc')
+    ProductionPosition = apps.get_model('produkcja', 'ProductionPosition')
+    InvoicePosition = apps.get_model('produkcja', 'InvoicePosition')
+
+    merged = 0
+    duplicated_docs = ProductionDoc.objects.values('month', 'order_number')\
+        .annotate(keep=Min('id'), count=Count('id')).filter(count__gt=1)
+    for row in duplicated_docs:
+        duplicates = ProductionDoc.objects.filter(month=row['month'], order_number=row['order_number'])\
+            .exclude(id=row['keep'])
+        ProductionPosition.objects.filter(production_doc__in=duplicates).update(production_doc=row['keep'])
+        merged += duplicates.delete()[0]
+
+    duplicated_positions = ProductionPosition.objects.values('production_doc', 'product')\
+        .annotate(keep=Min('id'), count=Count('id')).filter(count__gt=1)
+    for row in duplicated_positions:
+        duplicates = ProductionPosition.objects.filter(production_doc=row['production_doc'], product=row['product'])\
+            .exclude(id=row['keep'])
+        InvoicePosition.objects.filter(production_position__in=duplicates).update(production_position=row['keep'])
+        merged += duplicates.delete()[0]
+
+    if merged:
+        print(f"\n  merged {merged} duplicated production docs / positions, run manage.py rebuild_sales")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('produkcja', '0022_sales_columns'),
+    ]
+
+    operations = [
+        migrations.RunPython(merge_duplicates, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='invoice',
+            index=models.Index(fields=['month', 'warehouse_id'], name='invoice_month_warehouse_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='invoice',
+            index=models.Index(fields=['month', 'date'], name='invoice_month_date_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='productiondoc',
+            constraint=models.UniqueConstraint(fields=('month', 'order_number'), name='production_doc_month_order_uniq'),
+        ),
+        migrations.AddConstraint(
+            model_name='productionposition',
+            constraint=models.UniqueConstraint(fields=('production_doc', 'product'), name='production_position_doc_product_uniq'),
+        ),
+    ]
@@ -0,0 +1,34 @@
+# Generated by Django 4.0.1 on 2022-02-10 09:41
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('produkcja', '0023_lookup_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Job',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('step', models.CharField(choices=[('import', 'Pobierz dokumenty z F'), ('sync', 'Synchronizuj z F'), ('upload_to_odoo', 'Wyślij dokumenty do O'), ('check_production_status', 'Sprawdź status produkcji w O'), ('create_and_update_rws', 'Utwórz i ponumeruj RW'), ('update_rw_value', 'Uaktualnij wartość RW'), ('create_pws', 'Stwórz PW')], max_length=32)),
+                ('status', models.CharField(choices=[('queued', 'W kolejce'), ('running', 'W trakcie'), ('done', 'Gotowe'), ('failed', 'Błąd')], default='queued', max_length=8)),
+                ('progress', models.IntegerField(default=0)),
+                ('total', models.IntegerField(null=True)),
+                ('result', models.JSONField(null=True)),
+                ('error', models.TextField(null=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('started_at', models.DateTimeField(null=True)),
+                ('finished_at', models.DateTimeField(null=True)),
+                ('month', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='produkcja.month')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='job',
+            index=models.Index(fields=['status', 'id'], name='job_queue_idx'),
+        ),
+    ]
@@ -0,0 +1,22 @@
+# Generated by Django 4.0.1 on 2022-02-14 10:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('produkcja', '0024_job'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='warehouseaction',
+            name='date',
+            field=models.DateField(null=True),
+        ),
+        migrations.AddIndex(
+            model_name='warehouseaction',
+            index=models.Index(fields=['warehouse_id', 'date'], name='wh_action_date_idx'),
+        ),
+    ]
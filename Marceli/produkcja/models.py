@@ -1,6 +1,9 @@
 import datetime
 
+from decimal import Decimal
+
 from django.db import models
+from django.db.models import Prefetch
 from django.core.validators import MaxValueValidator, MinValueValidator
 
 
@@ -15,6 +18,8 @@ class Month(models.Model):
     year = models.IntegerField(default=default_year, validators=[MaxValueValidator(2099), MinValueValidator(2021)])
     month = models.IntegerField(default=default_month, validators=[MaxValueValidator(12), MinValueValidator(1)])
     odoo_id = models.IntegerField(unique=True, null=True)
+    # latest fakturownia updated_at seen by the last import or sync
+    sync_cursor = models.DateTimeField(null=True)
 
     @property
     def date_from(self):
@@ -33,11 +38,11 @@ class Month(models.Model):
 
     @property
     def production_docs(self):
-        return sorted(self.productiondoc_set.all(), key=lambda x: x.first_sale_date)
+        return self.productiondoc_set.with_positions().order_by('first_sale_date', 'id')
 
     @property
     def produced_docs(self):
-        return [doc for doc in self.production_docs if not doc.do_not_produce]
+        return self.production_docs.filter(do_not_produce=False)
 
     def __str__(self):
         return  str(self.month).zfill(2) + "." + str(self.year)
@@ -55,7 +60,11 @@ class Invoice(models.Model):
     currency = models.CharField(max_length=3)
     exchange_rate = models.DecimalField(max_digits=8, decimal_places=4)
 
-
+    class Meta:
+        indexes = [
+            models.Index(fields=['month', 'warehouse_id'], name='invoice_month_warehouse_idx'),
+            models.Index(fields=['month', 'date'], name='invoice_month_date_idx'),
+        ]
 
     @property
     def link(self):
@@ -96,6 +105,26 @@ class RW(models.Model):
         return self.number
 
 
+class ProductionDocQuerySet(models.QuerySet):
+    # position trees prefetched, so sales columns and positions are read without further queries
+    def with_positions(self):
+        positions = ProductionPosition.objects.select_related('product').prefetch_related(
+            Prefetch('invoiceposition_set', queryset=InvoicePosition.objects.select_related('invoice').order_by('id'))
+        ).order_by('id')
+        return self.select_related('month', 'rw').prefetch_related(Prefetch('productionposition_set', queryset=positions))
+
+    # recompute stored sales columns from positions, one query and one bulk update
+    def refresh_sales(self) -> list:
+        docs = list(self)
+        positions = {}
+        for position in ProductionPosition.objects.filter(production_doc__in=docs).order_by('id'):
+            positions.setdefault(position.production_doc_id, []).append(position)
+        for doc in docs:
+            doc.set_sales(positions.get(doc.id, []))
+        ProductionDoc.objects.bulk_update(docs, ProductionDoc.SALES_FIELDS)
+        return docs
+
+
 class ProductionDoc(models.Model):
     month = models.ForeignKey(Month, on_delete=models.CASCADE)
     order_number = models.CharField(max_length=8)
@@ -107,6 +136,19 @@ class ProductionDoc(models.Model):
     rw_date = models.DateField(null=True)
     pw_fakturownia_id = models.IntegerField(unique=True, null=True)
     pw_fakturownia_json = models.JSONField(null=True)
+    # sales of positions, kept up to date by set_sales / refresh_sales
+    first_sale_date = models.DateField(null=True)
+    sale_value = models.DecimalField(max_digits=20, decimal_places=6, default=0)
+    currency = models.CharField(max_length=3, null=True)
+
+    objects = ProductionDocQuerySet.as_manager()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['month', 'order_number'], name='production_doc_month_order_uniq'),
+        ]
+
+    SALES_FIELDS = ['first_sale_date', 'sale_value', 'currency']
 
     @property
     def production_positions(self):
@@ -116,29 +158,21 @@ class ProductionDoc(models.Model):
     def produced_positions(self):
         return [pos for pos in self.production_positions if not pos.do_not_produce]
 
-    @property
-    def first_sale_date(self):
-        try:
-            return min(pos.first_sale_date for pos in self.production_positions)
-        except TypeError:
-            return ""
-        except ValueError:
-            return ""
+    def set_sales(self, positions: list):
+        self.first_sale_date = min((pos.first_sale_date for pos in positions if pos.first_sale_date), default=None)
+        self.sale_value = sum((pos.value_pln for pos in positions if not pos.do_not_produce), Decimal(0))
+        self.currency = positions[0].currency if positions else None
 
-    @property
-    def sale_value(self):
-        return sum([position.value_pln for position in self.produced_positions])
+    def refresh_sales(self, save: bool = True):
+        self.set_sales(list(self.productionposition_set.order_by('id')))
+        if save:
+            self.save(update_fields=self.SALES_FIELDS)
 
     @property
     def sale_value_display(self):
         return str(round(self.sale_value, 2)) + " zł"
 
 
-    @property
-    def currency(self):
-        if self.production_positions:
-            return self.production_positions[0].currency
-
     @property
     def odoo_link(self):
         return f"https://marceli2.odoo.com/web?debug=#id={self.odoo_id}&action=1242&model=x_production_docs&view_type=form&menu_id=459"
@@ -155,6 +189,20 @@ class ProductionDoc(models.Model):
             return self.order_number + " - " + self.month.__str__()
 
 
+class ProductionPositionQuerySet(models.QuerySet):
+    # recompute stored sales columns from invoice positions, one query and one bulk update
+    def refresh_sales(self) -> list:
+        positions = list(self)
+        invoice_positions = {}
+        for invoice_position in InvoicePosition.objects.filter(production_position__in=positions)\
+                .select_related('invoice').order_by('id'):
+            invoice_positions.setdefault(invoice_position.production_position_id, []).append(invoice_position)
+        for position in positions:
+            position.set_sales(invoice_positions.get(position.id, []))
+        ProductionPosition.objects.bulk_update(positions, ProductionPosition.SALES_FIELDS)
+        return positions
+
+
 class ProductionPosition(models.Model):
     f_model_name = "warehouse_actions"
 
@@ -167,27 +215,40 @@ class ProductionPosition(models.Model):
     unit_price = models.DecimalField(max_digits=15, decimal_places=2, default=0)
     do_not_produce = models.BooleanField(default=False)
     odoo_id = models.IntegerField(unique=True, null=True)
+    # sales of linked invoice positions, kept up to date by set_sales / refresh_sales
+    quantity = models.DecimalField(max_digits=15, decimal_places=2, default=0)
+    sales_value = models.DecimalField(max_digits=15, decimal_places=2, default=0)
+    value_pln = models.DecimalField(max_digits=20, decimal_places=6, default=0)
+    first_sale_date = models.DateField(null=True)
+    currency = models.CharField(max_length=3, null=True)
+    exchange_rate = models.DecimalField(max_digits=8, decimal_places=4, default=1)
+
+    objects = ProductionPositionQuerySet.as_manager()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['production_doc', 'product'], name='production_position_doc_product_uniq'),
+        ]
+
+    SALES_FIELDS = ['quantity', 'sales_value', 'value_pln', 'first_sale_date', 'currency', 'exchange_rate']
 
     @property
     def invoice_positions(self):
         return self.invoiceposition_set.all()
 
-    @property
-    def quantity(self):
-        return sum(pos.quantity for pos in self.invoice_positions)
+    def set_sales(self, invoice_positions: list):
+        self.quantity = sum((pos.quantity for pos in invoice_positions), Decimal(0))
+        self.sales_value = sum((pos.total_price or 0 for pos in invoice_positions), Decimal(0))
+        # every sale converted with the exchange rate of its own invoice
+        self.value_pln = sum(((pos.total_price or 0) * pos.exchange_rate for pos in invoice_positions), Decimal(0))
+        self.first_sale_date = min((pos.invoice.date for pos in invoice_positions), default=None)
+        self.currency = invoice_positions[0].currency if invoice_positions else None
+        self.exchange_rate = invoice_positions[0].exchange_rate if invoice_positions else 1
 
-    @property
-    def sales_value(self):
-        return sum(pos.total_price for pos in self.invoice_positions)
-
-    @property
-    def first_sale_date(self):
-        try:
-            return min(pos.invoice.date for pos in self.invoice_positions)
-        except TypeError:
-            return ""
-        except ValueError:
-            return ""
+    def refresh_sales(self, save: bool = True):
+        self.set_sales(list(self.invoiceposition_set.select_related('invoice').order_by('id')))
+        if save:
+            self.save(update_fields=self.SALES_FIELDS)
 
     @property
     def prod_quantity(self):
@@ -197,13 +258,14 @@ class ProductionPosition(models.Model):
         else:
             return 0
 
-    def set_do_not_produce(self):
+    def set_do_not_produce(self, save: bool = True):
         name = self.product.name.lower()
         transport = "transport" in name
         advance = "rozliczenie" in name or "zaliczk" in name
         balance = self.balance >= 0
         self.do_not_produce = transport or advance or balance
-        self.save()
+        if save:
+            self.save()
 
     @property
     def sales_fraction(self):
@@ -216,23 +278,6 @@ class ProductionPosition(models.Model):
     def sales_fraction_display(self):
         return round(self.sales_fraction, 2)
 
-    @property
-    def currency(self):
-        if self.invoice_positions:
-            return self.invoice_positions[0].currency
-
-    @property
-    def exchange_rate(self):
-        if self.invoice_positions:
-            return self.invoice_positions[0].exchange_rate
-        else:
-            return 1
-
-    @property
-    def value_pln(self):
-        return self.sales_value * self.exchange_rate\
-
-
     @property
     def value_pln_display(self):
         return str(round(self.value_pln, 2)) + " zł"
@@ -265,5 +310,89 @@ class InvoicePosition(models.Model):
         return self.product.name
 
 
+class WarehouseAction(models.Model):
+    # local mirror of fakturownia warehouse actions; synced from shortly before the latest action's date,
+    # reconciled with the whole listing by the sync_warehouse_actions command
+    fakturownia_id = models.IntegerField(unique=True)
+    product_fakturownia_id = models.IntegerField(null=True)
+    warehouse_id = models.IntegerField()
+    quantity = models.DecimalField(max_digits=15, decimal_places=2)
+    date = models.DateField(null=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['warehouse_id', 'product_fakturownia_id'], name='wh_action_balance_idx'),
+            models.Index(fields=['warehouse_id', 'date'], name='wh_action_date_idx'),
+        ]
 
+    def __str__(self):
+        return f"{self.product_fakturownia_id}: {self.quantity}"
+
+
+class Job(models.Model):
+    # long-running month pipeline step, queued by the month page and run by `manage.py run_jobs`
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUSES = [(QUEUED, 'W kolejce'), (RUNNING, 'W trakcie'), (DONE, 'Gotowe'), (FAILED, 'Błąd')]
+
+    STEPS = [
+        ('import', 'Pobierz dokumenty z F'),
+        ('sync', 'Synchronizuj z F'),
+        ('upload_to_odoo', 'Wyślij dokumenty do O'),
+        ('check_production_status', 'Sprawdź status produkcji w O'),
+        ('create_and_update_rws', 'Utwórz i ponumeruj RW'),
+        ('update_rw_value', 'Uaktualnij wartość RW'),
+        ('create_pws', 'Stwórz PW'),
+    ]
 
+    month = models.ForeignKey(Month, on_delete=models.CASCADE)
+    step = models.CharField(max_length=32, choices=STEPS)
+    status = models.CharField(max_length=8, choices=STATUSES, default=QUEUED)
+    progress = models.IntegerField(default=0)
+    total = models.IntegerField(null=True)
+    result = models.JSONField(null=True)
+    error = models.TextField(null=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True)
+    finished_at = models.DateTimeField(null=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'id'], name='job_queue_idx'),
+        ]
+
+    @classmethod
+    def enqueue(cls, month: Month, step: str):
+        # pressing a button twice does not queue the step twice
+        job = cls.objects.filter(month=month, step=step, status=cls.QUEUED).first()
+        return job or cls.objects.create(month=month, step=step)
+
+    # progress is written straight to the row, so the month page sees it while the step runs
+    def set_progress(self, progress: int, total: int = None):
+        self.progress = progress
+        if total is not None:
+            self.total = total
+        Job.objects.filter(pk=self.pk).update(progress=self.progress, total=self.total)
+
+    @property
+    def active(self):
+        return self.status in (self.QUEUED, self.RUNNING)
+
+    def as_dict(self):
+        return {
+            'id': self.id,
+            'step': self.get_step_display(),
+            'status': self.status,
+            'status_display': self.get_status_display(),
+            'progress': self.progress,
+            'total': self.total,
+            'result': self.result,
+            'error': self.error.strip().splitlines()[-1] if self.error else None,
+            'created_at': self.created_at.isoformat() if self.created_at else None,
+            'finished_at': self.finished_at.isoformat() if self.finished_at else None,
+        }
+
+    def __str__(self):
+        return f"{self.get_step_display()} - {self.month} ({self.status})"
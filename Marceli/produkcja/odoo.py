@@ -1,49 +1,231 @@
 import xmlrpc.client
+import http.client
+import json
+import queue
+import threading
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.functional import SimpleLazyObject
 from .models import ProductionDoc, Month, ProductionPosition, RW
-import environ
+from .resilience import CircuitBreaker, Retry
 import datetime
 
-env = environ.Env()
-environ.Env.read_env()
+# max records sent in a single create call
+CREATE_BATCH_SIZE = 500
+# max ids read in a single search_read call
+READ_BATCH_SIZE = 1000
+# request bodies over this many bytes are gzipped when compression is on, smaller ones fit a packet anyway
+COMPRESS_THRESHOLD = 1400
+
 
 def format_date(date: datetime.date) -> str:
     return date.strftime("%Y-%m-%d")
 
+# methods safe to send again when the answer got lost, writes set the same values again
+IDEMPOTENT_METHODS = {'search', 'search_read', 'search_count', 'read', 'fields_get', 'write'}
+
+
+class OdooUnavailable(Exception):
+    pass
+
+
+class PooledTransport(xmlrpc.client.Transport):
+    # keep-alive transport with a pool of connections, each thread borrows its own connection for a call
+    # timeouts are in seconds, compress gzips request bodies - odoo has to sit behind a proxy accepting them
+    def __init__(self, use_https: bool = False, timeout: float = 60, pool_size: int = 4, compress: bool = False,
+                 connect_timeout: float = None):
+        super().__init__()
+        self.use_https = use_https
+        self.timeout = timeout
+        self.connect_timeout = connect_timeout or timeout
+        self.pool_size = pool_size
+        # xmlrpc's Transport never gzips requests unless given a threshold
+        self.encode_threshold = COMPRESS_THRESHOLD if compress else None
+        self.pools = {}
+        self.pools_lock = threading.Lock()
+        self.local = threading.local()
+
+    def pool(self, host) -> queue.LifoQueue:
+        with self.pools_lock:
+            return self.pools.setdefault(host, queue.LifoQueue(maxsize=self.pool_size))
+
+    def make_connection(self, host):
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            try:
+                connection = self.pool(host).get_nowait()
+            except queue.Empty:
+                chost, self._extra_headers, x509 = self.get_host_info(host)
+                if self.use_https:
+                    connection = http.client.HTTPSConnection(chost, timeout=self.connect_timeout)
+                else:
+                    connection = http.client.HTTPConnection(chost, timeout=self.connect_timeout)
+                connection.connect = self.connect_with_deadlines(connection)
+            self.local.connection = connection
+            self.local.host = host
+        return connection
+
+    # connect within connect_timeout, then wait for answers up to timeout
+    def connect_with_deadlines(self, connection):
+        connect = connection.connect
+
+        def connect_then_read_timeout():
+            connect()
+            connection.sock.settimeout(self.timeout)
+        return connect_then_read_timeout
+
+    def single_request(self, host, handler, request_body, verbose=False):
+        try:
+            return super().single_request(host, handler, request_body, verbose)
+        finally:
+            self.release()
+
+    # give the connection back to the pool once the response was read
+    def release(self):
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            return
+        self.local.connection = None
+        try:
+            self.pool(self.local.host).put_nowait(connection)
+        except queue.Full:
+            connection.close()
+
+    def close(self):
+        connection = getattr(self.local, 'connection', None)
+        if connection is not None:
+            self.local.connection = None
+            connection.close()
+
+
 class Odoo:
-    def __init__(self):
+    def __init__(self, timeout: float = None, pool_size: int = None, compress: bool = None,
+                 retry: Retry = None, breaker: CircuitBreaker = None):
 
-        self.url = env('URL')
-        self.db = env('DB')
-        self.username = env('ODOO_USERNAME')
-        self.password = env('PASSWORD')
+        self.url = settings.ODOO_URL
+        self.db = settings.ODOO_DB
+        self.username = settings.ODOO_USERNAME
+        self.password = settings.ODOO_PASSWORD
+        if not all([self.url, self.db, self.username, self.password]):
+            raise ImproperlyConfigured("URL, DB, ODOO_USERNAME and PASSWORD for Odoo have to be set")
+
+        # one pooled transport shared by both endpoints
+        self.transport = PooledTransport(
+            self.url.startswith('https'),
+            settings.ODOO_TIMEOUT if timeout is None else timeout,
+            pool_size or settings.ODOO_POOL_SIZE,
+            settings.ODOO_COMPRESS if compress is None else compress,
+            settings.ODOO_CONNECT_TIMEOUT,
+        )
+        self.common = xmlrpc.client.ServerProxy('{}/xmlrpc/2/common'.format(self.url), transport=self.transport)
+        self.models = xmlrpc.client.ServerProxy('{}/xmlrpc/2/object'.format(self.url), transport=self.transport)
+        self._uid = None
+        self.auth_lock = threading.Lock()
+        self.retry = retry or Retry(settings.ODOO_RETRIES, settings.RETRY_BACKOFF, settings.RETRY_MAX_BACKOFF,
+                                    retry_on=(OSError, http.client.HTTPException, OdooUnavailable))
+        self.breaker = breaker or CircuitBreaker("Odoo", settings.CIRCUIT_FAILURE_THRESHOLD,
+                                                 settings.CIRCUIT_RESET_TIMEOUT)
 
-        self.common = xmlrpc.client.ServerProxy('{}/xmlrpc/2/common'.format(self.url))
-        self.uid = self.common.authenticate(self.db, self.username, self.password, {})
-        self.models = xmlrpc.client.ServerProxy('{}/xmlrpc/2/object'.format(self.url))
+        # writes queued by update_* methods, sent by flush()
+        self.pending_updates = []
+        self.pending_lock = threading.Lock()
+        self.multicall = settings.ODOO_MULTICALL
+
+    # authenticated on first call, not when the client is created
+    @property
+    def uid(self):
+        if self._uid is None:
+            with self.auth_lock:
+                if self._uid is None:
+                    self._uid = self.call(lambda: self.common.authenticate(self.db, self.username, self.password, {}))
+        return self._uid
+
+    # send a call through the circuit breaker, retried on network errors and 5xx when it is safe to send again;
+    # faults are odoo's answers and pass through as they are
+    def call(self, send, retryable: bool = True):
+        def attempt():
+            try:
+                return send()
+            except xmlrpc.client.ProtocolError as e:
+                if e.errcode >= 500:
+                    raise OdooUnavailable(f"{e.errcode} {e.errmsg}") from e
+                raise
+        return self.retry.call(attempt, self.breaker, retryable)
+
+    def execute_kw(self, odoo_model: str, method: str, args: list, kwargs: dict = None):
+        uid = self.uid
+        retryable = method in IDEMPOTENT_METHODS
+        try:
+            return self.call(lambda: self.models.execute_kw(self.db, uid, self.password, odoo_model, method, args,
+                                                            kwargs or {}), retryable)
+        except xmlrpc.client.Fault as fault:
+            if 'Access Denied' not in fault.faultString and 'Session expired' not in fault.faultString:
+                raise
+            # session expired or password rotated - log in again once and retry
+            with self.auth_lock:
+                if self._uid == uid:
+                    self._uid = None
+            return self.call(lambda: self.models.execute_kw(self.db, self.uid, self.password, odoo_model, method, args,
+                                                            kwargs or {}), retryable)
 
     # # CREATE
     def create(self, odoo_model: str, fields: dict):
-        return self.models.execute_kw(self.db, self.uid, self.password, odoo_model, 'create', [fields])
+        return self.execute_kw(odoo_model, 'create', [fields])
+
+    # create many records in one call per batch, returns ids in order of given values;
+    # created, if given, is called with the number of records of each batch
+    def create_many(self, odoo_model: str, values: list, batch_size: int = CREATE_BATCH_SIZE,
+                    created=None) -> list:
+        ids = []
+        for start in range(0, len(values), batch_size):
+            batch = values[start:start + batch_size]
+            ids += self.execute_kw(odoo_model, 'create', [batch])
+            if created:
+                created(len(batch))
+        return ids
+
+    # create / Month; progress, if given, is called with the number of records created so far and their count
+    def create_production(self, month: Month, progress=None):
+        rws = {rw.id: rw for rw in month.rw_set.all()}
+        docs = list(month.production_docs)
+        positions = [(doc, position) for doc in docs for position in doc.production_positions]
+        total = 1 + len(rws) + len(docs) + len(positions)
+        done = 0
+
+        def created(count: int):
+            nonlocal done
+            done += count
+            if progress:
+                progress(done, total)
 
-    # create / Month
-    def create_production(self, month: Month):
         fields = {'x_name': month.__str__()}
         month.odoo_id = self.create('x_production', fields)
         month.save()
-        for rw in month.rw_set.all():
-            rw.odoo_id = self.create_rw(rw)
-            rw.save()
+        created(1)
+
+        odoo_ids = self.create_many('x_rw', [self.rw_fields(rw) for rw in rws.values()], created=created)
+        for rw, odoo_id in zip(rws.values(), odoo_ids):
+            rw.odoo_id = odoo_id
+        RW.objects.bulk_update(rws.values(), ['odoo_id'])
+
+        for doc in docs:
+            if doc.rw_id in rws:
+                doc.rw = rws[doc.rw_id]
+        odoo_ids = self.create_many('x_production_docs', [self.production_doc_fields(doc, month.odoo_id) for doc in docs],
+                                    created=created)
+        for doc, odoo_id in zip(docs, odoo_ids):
+            doc.odoo_id = odoo_id
+        ProductionDoc.objects.bulk_update(docs, ['odoo_id'])
 
-        for doc in month.production_docs:
-            doc.odoo_id = self.create_production_doc(doc, month.odoo_id)
-            doc.save()
-            for position in doc.production_positions:
-                position.odoo_id = self.create_production_position(doc.odoo_id, position)
-                position.save()
+        odoo_ids = self.create_many('x_production_positions', [self.production_position_fields(doc.odoo_id, position)
+                                                                for doc, position in positions], created=created)
+        for (doc, position), odoo_id in zip(positions, odoo_ids):
+            position.odoo_id = odoo_id
+        ProductionPosition.objects.bulk_update([position for doc, position in positions], ['odoo_id'])
 
     # create / RW
-    def create_rw(self, rw: RW):
-        fields = {
+    def rw_fields(self, rw: RW) -> dict:
+        return {
             'x_name': "RW " + rw.number,
             'x_number': rw.number,
             'x_date': rw.issue_date,
@@ -51,10 +233,12 @@ class Odoo:
             'x_link_url': rw.link,
             'x_fakturownia_id': rw.fakturownia_id
         }
-        return self.create("x_rw", fields)
+
+    def create_rw(self, rw: RW):
+        return self.create("x_rw", self.rw_fields(rw))
 
     # create / prod doc
-    def create_production_doc(self, prod_doc: ProductionDoc, month: int):
+    def production_doc_fields(self, prod_doc: ProductionDoc, month: int) -> dict:
         fields = {
             'x_name': prod_doc.order_number,
             'x_order_number': prod_doc.order_number,
@@ -64,12 +248,14 @@ class Odoo:
         }
         if prod_doc.rw and prod_doc.rw.odoo_id:
             fields['x_rw'] = prod_doc.rw.odoo_id
+        return fields
 
-        return self.create('x_production_docs', fields)
+    def create_production_doc(self, prod_doc: ProductionDoc, month: int):
+        return self.create('x_production_docs', self.production_doc_fields(prod_doc, month))
 
     # create / prod pos
-    def create_production_position(self, prod_doc_id, prod_pos: ProductionPosition):
-        fields = {
+    def production_position_fields(self, prod_doc_id, prod_pos: ProductionPosition) -> dict:
+        return {
             'x_name': prod_pos.product.name,
             'x_production_doc': prod_doc_id,
             'x_product_id': prod_pos.product.fakturownia_id,
@@ -80,67 +266,170 @@ class Odoo:
             "x_studio_produced_quantity": prod_pos.prod_quantity,
             'x_dont_produce': prod_pos.do_not_produce,
         }
-        return self.create('x_production_positions', fields)
+
+    def create_production_position(self, prod_doc_id, prod_pos: ProductionPosition):
+        return self.create('x_production_positions', self.production_position_fields(prod_doc_id, prod_pos))
 
     # # GET
     def get(self, odoo_model:str, odoo_id: int, fields:list):
-        return self.models.execute_kw(
-            self.db,
-            self.uid,
-            self.password,
-            odoo_model,
-            'search_read',
-            [[['id', '=', odoo_id]]],
-            {'fields': fields}
-        )
+        return self.execute_kw(odoo_model, 'search_read', [[['id', '=', odoo_id]]], {'fields': fields})
+
+    # get many records in one call per batch, returns records by id
+    def get_many(self, odoo_model: str, odoo_ids: list, fields: list, batch_size: int = READ_BATCH_SIZE) -> dict:
+        records = {}
+        for start in range(0, len(odoo_ids), batch_size):
+            batch = odoo_ids[start:start + batch_size]
+            records.update((record['id'], record) for record in self.execute_kw(
+                odoo_model, 'search_read', [[['id', 'in', batch]]], {'fields': fields}
+            ))
+        return records
 
     # get / prod doc
-    def get_production_status(self, prod_doc: ProductionDoc):
-        fields = ["x_dont_produce", 'x_studio_order_name']
-        docs = self.get("x_production_docs", prod_doc.odoo_id, fields)
-        odoo_doc = docs[0]
+    PRODUCTION_DOC_STATUS_FIELDS = ["x_dont_produce", 'x_studio_order_name']
+
+    def apply_production_status(self, prod_doc: ProductionDoc, odoo_doc: dict):
         prod_doc.do_not_produce = odoo_doc['x_dont_produce']
         prod_doc.order_name = odoo_doc['x_studio_order_name']
+
+    def get_production_status(self, prod_doc: ProductionDoc):
+        docs = self.get("x_production_docs", prod_doc.odoo_id, self.PRODUCTION_DOC_STATUS_FIELDS)
+        self.apply_production_status(prod_doc, docs[0])
         prod_doc.save()
 
     # get / prod position
-    def get_production_position_status(self, position: ProductionPosition):
-        fields = [
-            "x_dont_produce",
-            'x_studio_produced_quantity',
-            'x_studio_raw_materials_value',
-            'x_studio_unit_price',
-        ]
-        response = self.get('x_production_positions', position.odoo_id, fields)
-        odoo_position = response[0]
-        print(odoo_position)
+    PRODUCTION_POSITION_STATUS_FIELDS = [
+        "x_dont_produce",
+        'x_studio_produced_quantity',
+        'x_studio_raw_materials_value',
+        'x_studio_unit_price',
+    ]
+
+    def apply_production_position_status(self, position: ProductionPosition, odoo_position: dict):
         position.final_quantity = odoo_position['x_studio_produced_quantity']
         position.do_not_produce = odoo_position['x_dont_produce']
         position.raw_materials_value = odoo_position['x_studio_raw_materials_value']
         position.unit_price = odoo_position['x_studio_unit_price']
+
+    def get_production_position_status(self, position: ProductionPosition):
+        response = self.get('x_production_positions', position.odoo_id, self.PRODUCTION_POSITION_STATUS_FIELDS)
+        self.apply_production_position_status(position, response[0])
         position.save()
 
+    # get / all prod docs and positions of a month, two calls; progress, if given, is called with the number
+    # of records read so far and their count
+    def get_month_production_status(self, month: Month, progress=None):
+        docs = [doc for doc in month.productiondoc_set.all() if doc.odoo_id]
+        positions = [position for position in ProductionPosition.objects.filter(production_doc__month=month)
+                     if position.odoo_id]
+        total = len(docs) + len(positions)
+        if progress:
+            progress(0, total)
+        odoo_docs = self.get_many("x_production_docs", [doc.odoo_id for doc in docs],
+                                  self.PRODUCTION_DOC_STATUS_FIELDS)
+        docs = [doc for doc in docs if doc.odoo_id in odoo_docs]
+        for doc in docs:
+            self.apply_production_status(doc, odoo_docs[doc.odoo_id])
+        ProductionDoc.objects.bulk_update(docs, ['do_not_produce', 'order_name'])
+        if progress:
+            progress(total - len(positions))
+
+        odoo_positions = self.get_many('x_production_positions', [position.odoo_id for position in positions],
+                                       self.PRODUCTION_POSITION_STATUS_FIELDS)
+        positions = [position for position in positions if position.odoo_id in odoo_positions]
+        for position in positions:
+            self.apply_production_position_status(position, odoo_positions[position.odoo_id])
+        ProductionPosition.objects.bulk_update(positions, ['final_quantity', 'do_not_produce',
+                                                           'raw_materials_value', 'unit_price'])
+        if progress:
+            progress(total)
+        # sale value of docs counts produced positions only
+        month.productiondoc_set.all().refresh_sales()
+        print(f"Status of {len(docs)} production docs and {len(positions)} positions updated")
+
 
     def update(self, odoo_model: str, odoo_id: int, fields:dict):
-        self.models.execute_kw(
-            self.db,
-            self.uid,
-            self.password,
-            odoo_model,
-            'write',
-            [[odoo_id], fields]
-        )
+        self.update_many(odoo_model, [odoo_id], fields)
+
+    def update_many(self, odoo_model: str, odoo_ids: list, fields: dict):
+        self.execute_kw(odoo_model, 'write', [odoo_ids, fields])
+
+    # queue a write, sent with the next flush()
+    def queue_update(self, odoo_model: str, odoo_id: int, fields: dict):
+        with self.pending_lock:
+            self.pending_updates.append((odoo_model, odoo_id, fields))
+
+    # send queued writes: identical values as one multi-id write, the rest through multicall batches
+    def flush(self, batch_size: int = None):
+        with self.pending_lock:
+            pending, self.pending_updates = self.pending_updates, []
+        if not pending:
+            return
+
+        # later writes to the same record override earlier ones
+        records = {}
+        for odoo_model, odoo_id, fields in pending:
+            records.setdefault((odoo_model, odoo_id), {}).update(fields)
+
+        groups = {}
+        for (odoo_model, odoo_id), fields in records.items():
+            key = (odoo_model, json.dumps(fields, sort_keys=True, default=str))
+            groups.setdefault(key, (odoo_model, fields, []))[2].append(odoo_id)
+
+        writes = list(groups.values())
+        batch_size = batch_size or settings.ODOO_MULTICALL_BATCH_SIZE
+        for start in range(0, len(writes), batch_size):
+            self.write_batch(writes[start:start + batch_size])
+        print(f"Flushed {len(pending)} queued odoo updates in {len(writes)} writes")
+
+    def write_batch(self, writes: list):
+        if self.multicall and len(writes) > 1:
+            multicall = xmlrpc.client.MultiCall(self.models)
+            for odoo_model, fields, odoo_ids in writes:
+                multicall.execute_kw(self.db, self.uid, self.password, odoo_model, 'write', [odoo_ids, fields])
+            try:
+                results = self.call(multicall)
+            except xmlrpc.client.Fault:
+                # server without system.multicall, writes are sent one by one from now on
+                self.multicall = False
+            else:
+                for _ in results:
+                    pass  # raises the fault of a failed write
+                return
+        for odoo_model, fields, odoo_ids in writes:
+            self.update_many(odoo_model, odoo_ids, fields)
 
     # update / prod doc
     def update_pd(self, doc: ProductionDoc, pd_fields:dict):
-        self.update("x_production_docs", doc.odoo_id, pd_fields)
+        self.queue_update("x_production_docs", doc.odoo_id, pd_fields)
 
     # update / RW
     def update_rw(self, rw: RW, rw_fields: dict):
         print(f"Updating rw {rw}, odoo id: {rw.odoo_id}, fields: {rw_fields}")
-        self.update("x_rw", rw.odoo_id, rw_fields)
+        self.queue_update("x_rw", rw.odoo_id, rw_fields)
 
     # update / prod pos
     def update_position(self, position: ProductionPosition, fields: dict):
         print(f"Updating position {position} odoo id: {position.odoo_id}, fields: {fields}")
-        self.update("x_production_positions", position.odoo_id, fields)
+        self.queue_update("x_production_positions", position.odoo_id, fields)
+
+
+_odoo = None
+_odoo_lock = threading.Lock()
+
+
+def get_odoo() -> Odoo:
+    global _odoo
+    with _odoo_lock:
+        if _odoo is None:
+            _odoo = Odoo()
+        return _odoo
+
+
+# shared client, created on first use
+odoo = SimpleLazyObject(get_odoo)
+
+
+# send writes queued on the shared client, without creating it when nothing has used it
+def flush_odoo():
+    if _odoo is not None:
+        _odoo.flush()
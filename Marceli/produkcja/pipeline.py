@@ -0,0 +1,252 @@
+import statistics
+import threading
+import time
+import traceback
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
+
+from django.db import close_old_connections, connections, transaction
+from django.db.models import Prefetch
+from django.utils import timezone
+from .models import Month, Job, ProductionDoc, ProductionPosition, RW
+from .fakturownia import fakturownia, create_fakturownia_rw, update_fakturownia_rw, request_rw_values, pw_payload, \
+    submit_pws
+from .importer import import_month, sync_month
+from .odoo import odoo, flush_odoo
+from .logic import generate_rw_numbers_dates, create_new_django_rw, assign_raw_materials
+
+
+# month pipeline steps, run by the job worker; each takes the month and its job for progress reporting
+
+def import_documents(month: Month, job: Job):
+    return import_month(month, job.set_progress)
+
+
+def sync_documents(month: Month, job: Job):
+    return sync_month(month, job.set_progress)
+
+
+def upload_docs_to_odoo(month: Month, job: Job):
+    odoo.create_production(month, job.set_progress)
+
+
+def check_production_status(month: Month, job: Job):
+    odoo.get_month_production_status(month, job.set_progress)
+    generate_rw_numbers_dates(month)
+
+
+# rw fields odoo can only get once the rw exists in fakturownia
+RW_FAKTUROWNIA_FIELDS = ['x_link_url', 'x_fakturownia_id']
+
+
+# creates the rw and whichever of its fakturownia and odoo documents is missing, e.g. after one of them
+# failed on an earlier run
+def create_rw(doc: ProductionDoc, calls: ThreadPoolExecutor):
+    if doc.rw is None:
+        with transaction.atomic():
+            create_new_django_rw(doc)
+    rw = doc.rw
+
+    # fakturownia and odoo documents are created at the same time, odoo gets the fakturownia link afterwards
+    odoo_fields = {name: value for name, value in odoo.rw_fields(rw).items() if name not in RW_FAKTUROWNIA_FIELDS}
+    created = {}
+    if rw.fakturownia_id is None:
+        created['fakturownia_id'] = calls.submit(create_fakturownia_rw, rw)
+    if rw.odoo_id is None:
+        created['odoo_id'] = calls.submit(odoo.create, "x_rw", odoo_fields)
+    # ids of documents that got created are kept even when the other call failed
+    errors = []
+    for field, future in created.items():
+        try:
+            setattr(rw, field, future.result())
+        except Exception as e:
+            errors.append(e)
+    rw.save(update_fields=list(created))
+    if errors:
+        raise errors[0]
+
+    # a document made on an earlier run is brought up to date like in update_rw
+    if 'fakturownia_id' not in created:
+        update_fakturownia_rw(rw)
+    link_fields = {'x_link_url': rw.link, 'x_fakturownia_id': rw.fakturownia_id}
+    odoo.update_rw(rw, link_fields if 'odoo_id' in created else {**odoo_fields, **link_fields})
+    odoo.update_pd(doc, {'x_rw': rw.odoo_id})
+
+
+def update_rw(doc: ProductionDoc):
+    rw = doc.rw
+    fields = {
+        'x_name': "RW " + rw.number,
+        'x_number': rw.number,
+        'x_date': rw.issue_date,
+    }
+    odoo.update_rw(rw, fields)
+    update_fakturownia_rw(rw)
+
+
+def latency_summary(latencies: list) -> dict:
+    latencies = sorted(latencies)
+    if not latencies:
+        return {}
+    return {
+        'min_ms': round(latencies[0] * 1000),
+        'median_ms': round(statistics.median(latencies) * 1000),
+        'p95_ms': round(latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))] * 1000),
+        'max_ms': round(latencies[-1] * 1000),
+    }
+
+
+# docs are independent, so their rws are created or updated in parallel, bounded by the http pool size
+def create_and_update_rws(month: Month, job: Job):
+    docs = list(month.productiondoc_set.filter(do_not_produce=False).select_related('month', 'rw')
+                .order_by('first_sale_date', 'id'))
+    job.set_progress(0, len(docs))
+    workers = min(fakturownia.pool_size, len(docs)) or 1
+    done = []
+    done_lock = threading.Lock()
+
+    def run(doc: ProductionDoc):
+        start = time.perf_counter()
+        try:
+            if doc.rw and doc.rw.fakturownia_id is not None and doc.rw.odoo_id is not None:
+                update_rw(doc)
+                outcome = 'updated'
+            else:
+                create_rw(doc, calls)
+                outcome = 'created'
+        except Exception as e:
+            print(f"RW for {doc} failed: {e!r}")
+            outcome = 'failed'
+        finally:
+            latency = time.perf_counter() - start
+            with done_lock:
+                done.append(latency)
+                job.set_progress(len(done))
+            connections.close_all()
+        return outcome, latency, doc
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as executor, ThreadPoolExecutor(max_workers=workers) as calls:
+        results = list(executor.map(run, docs))
+
+    outcomes = Counter(outcome for outcome, _, _ in results)
+    summary = {
+        'docs': len(docs),
+        **{outcome: outcomes[outcome] for outcome in ('created', 'updated', 'failed')},
+        'wall_ms': round((time.perf_counter() - start) * 1000),
+        **latency_summary([latency for _, latency, _ in results]),
+    }
+    print(f"RWs for {month}: {summary}")
+    failed = [str(doc) for outcome, _, doc in results if outcome == 'failed']
+    if failed:
+        raise RuntimeError(f"RWs failed for {', '.join(failed)}; {summary}")
+    return summary
+
+
+# rw values are fetched in parallel, so the step takes about as long as the slowest request
+def update_rw_value(month: Month, job: Job):
+    rws = list(RW.objects.filter(productiondoc__month=month, productiondoc__do_not_produce=False)
+               .exclude(fakturownia_id=None).distinct())
+    job.set_progress(0, len(rws))
+    for n, (rw, value) in enumerate(request_rw_values(rws)):
+        rw.value = Decimal(str(value)).quantize(Decimal('0.01'))
+        # the value of an rw not in odoo yet is only stored, a run after its upload sends it
+        if rw.odoo_id is not None:
+            odoo.update_rw(rw, {'x_studio_value': value})
+        job.set_progress(n + 1)
+    RW.objects.bulk_update(rws, ['value'])
+    assign_raw_materials(month)
+    return {'rws': len(rws)}
+
+
+# pws of all produced docs of the month; docs that already have one are skipped, so a failed run can be resumed
+def create_pws(month: Month, job: Job):
+    positions = ProductionPosition.objects.select_related('product').order_by('id')
+    docs = list(month.productiondoc_set.filter(do_not_produce=False, pw_fakturownia_id=None)
+                .prefetch_related(Prefetch('productionposition_set', queryset=positions))
+                .order_by('first_sale_date', 'id'))
+    created, failed, payloads = [], [], []
+    for doc in docs:
+        try:
+            payloads.append((doc, pw_payload(doc)))
+        except Exception as e:
+            print(f"PW for {doc} not built: {e!r}")
+            failed.append(str(doc))
+    job.set_progress(0, len(payloads))
+
+    try:
+        for n, (doc, document) in enumerate(submit_pws(payloads)):
+            if isinstance(document, Exception):
+                print(f"PW for {doc} failed: {document!r}")
+                failed.append(str(doc))
+            else:
+                doc.pw_fakturownia_id = document['id']
+                doc.pw_fakturownia_json = document
+                created.append(doc)
+            job.set_progress(n + 1)
+    finally:
+        # pws created in fakturownia are recorded also when the run stops halfway
+        ProductionDoc.objects.bulk_update(created, ['pw_fakturownia_id', 'pw_fakturownia_json'], batch_size=100)
+
+    if failed:
+        raise RuntimeError(f"PWs failed for {', '.join(failed)}; {len(created)} created")
+    return {'pws created': len(created)}
+
+
+STEPS = {
+    'import': import_documents,
+    'sync': sync_documents,
+    'upload_to_odoo': upload_docs_to_odoo,
+    'check_production_status': check_production_status,
+    'create_and_update_rws': create_and_update_rws,
+    'update_rw_value': update_rw_value,
+    'create_pws': create_pws,
+}
+
+
+# take the oldest queued job of a month that has no job running; the busy month check is repeated in the
+# claiming update, so of two workers picking jobs of one month only the first gets one - sqlite runs one
+# write at a time, without row locks
+def claim_job():
+    busy_months = Job.objects.filter(status=Job.RUNNING).values('month')
+    candidates = Job.objects.filter(status=Job.QUEUED).exclude(month__in=busy_months)\
+        .order_by('id').values_list('id', flat=True)[:10]
+    for job_id in candidates:
+        if Job.objects.filter(id=job_id, status=Job.QUEUED).exclude(month__in=busy_months)\
+                .update(status=Job.RUNNING, started_at=timezone.now()):
+            return Job.objects.select_related('month').get(id=job_id)
+    return None
+
+
+def run_job(job: Job):
+    print(f"Running {job}")
+    try:
+        job.result = STEPS[job.step](job.month, job)
+        job.status = Job.DONE
+    except Exception:
+        job.status = Job.FAILED
+        job.error = traceback.format_exc()
+    # odoo writes queued by the step are sent also when it failed halfway; a failed flush fails the job
+    # but keeps the step's result and error
+    try:
+        flush_odoo()
+    except Exception:
+        job.status = Job.FAILED
+        job.error = (job.error or '') + traceback.format_exc()
+    if job.error:
+        print(job.error)
+    job.finished_at = timezone.now()
+    job.save(update_fields=['status', 'result', 'error', 'finished_at'])
+    print(f"Finished {job}")
+    return job
+
+
+# run queued jobs until none is left, returns how many were run
+def run_pending_jobs() -> int:
+    count = 0
+    while job := claim_job():
+        run_job(job)
+        close_old_connections()
+        count += 1
+    return count
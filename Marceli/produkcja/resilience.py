@@ -0,0 +1,175 @@
+import random
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+
+class CircuitOpen(Exception):
+    pass
+
+
+class RetryableResult(Exception):
+    # raised by a call whose result asks for a retry (e.g. http 503); carries the result to return when out of retries
+    def __init__(self, result):
+        super().__init__(result)
+        self.result = result
+
+
+class CircuitBreaker:
+    # closed: calls go through; open: calls fail fast for reset_timeout seconds after failure_threshold failures
+    # in a row; half-open: after that one trial call decides between closed and open again
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, name: str, failure_threshold: int = 5, reset_timeout: float = 30, clock=time.monotonic):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.clock = clock
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self.trial_running = False
+        self.lock = threading.Lock()
+
+    def before_call(self):
+        with self.lock:
+            if self.state == self.OPEN:
+                if self.clock() - self.opened_at < self.reset_timeout:
+                    raise CircuitOpen(f"{self.name} is unavailable, circuit open after {self.failures} failures")
+                self.state = self.HALF_OPEN
+                self.trial_running = False
+            if self.state == self.HALF_OPEN:
+                if self.trial_running:
+                    raise CircuitOpen(f"{self.name} is unavailable, waiting for a trial call")
+                self.trial_running = True
+
+    def record_success(self):
+        with self.lock:
+            self.state = self.CLOSED
+            self.failures = 0
+            self.trial_running = False
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            self.trial_running = False
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                self.state = self.OPEN
+                self.opened_at = self.clock()
+
+
+class Retry:
+    # exponential backoff with full jitter: attempt n waits random(0, min(max_backoff, backoff * 2 ** n)) seconds
+    def __init__(self, retries: int = 3, backoff: float = 0.5, max_backoff: float = 10, retry_on: tuple = (),
+                 sleep=time.sleep, rng: random.Random = None):
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.retry_on = retry_on + (RetryableResult,)
+        self.sleep = sleep
+        self.rng = rng or random.Random()
+
+    def delay(self, attempt: int) -> float:
+        return self.rng.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+    # call func through the breaker; failures matching retry_on count against the breaker and are retried
+    # when retryable is true, other exceptions are raised at once and leave the breaker alone
+    def call(self, func, breaker: CircuitBreaker = None, retryable: bool = True):
+        attempt = 0
+        while True:
+            if breaker:
+                breaker.before_call()
+            try:
+                result = func()
+            except self.retry_on as e:
+                if breaker:
+                    breaker.record_failure()
+                if not retryable or attempt >= self.retries:
+                    if isinstance(e, RetryableResult):
+                        return e.result
+                    raise
+                print(f"Retrying after {e!r}, attempt {attempt + 1} of {self.retries}")
+                self.sleep(self.delay(attempt))
+                attempt += 1
+            except Exception:
+                if breaker:
+                    breaker.record_success()  # upstream answered, the call itself was wrong
+                raise
+            else:
+                if breaker:
+                    breaker.record_success()
+                return result
+
+
+class RateLimiter:
+    # token buckets kept in a small sqlite file, so all threads and processes using the file share them;
+    # bucket name -> (rate, burst): it refills at rate tokens a second up to burst, a call takes one token.
+    # A throttled bucket gives no tokens until the server's Retry-After passes and its rate is halved,
+    # then grows back to the configured rate over recovery seconds
+    def __init__(self, path: str, rates: dict, recovery: float = 60, min_share: float = 0.1,
+                 clock=time.time, sleep=time.sleep):
+        self.path = str(path)
+        self.rates = rates
+        self.recovery = recovery
+        self.min_share = min_share
+        self.clock = clock  # wall clock, shared by processes
+        self.sleep = sleep
+        self.local = threading.local()
+
+    @contextmanager
+    def transaction(self):
+        db = getattr(self.local, 'db', None)
+        if db is None:
+            db = self.local.db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            db.execute("CREATE TABLE IF NOT EXISTS buckets "
+                       "(name TEXT PRIMARY KEY, tokens REAL, rate REAL, updated REAL, blocked_until REAL)")
+        # takes the file's write lock at once, so reading and updating a bucket is atomic across processes
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            yield db
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        db.execute("COMMIT")
+
+    def bucket(self, db, name: str, now: float) -> tuple:
+        rate, burst = self.rates[name]
+        row = db.execute("SELECT tokens, rate, updated, blocked_until FROM buckets WHERE name = ?",
+                         (name,)).fetchone()
+        tokens, current, updated, blocked_until = row or (burst, rate, now, 0)
+        elapsed = max(0, now - updated)
+        current = min(rate, current + rate * elapsed / self.recovery)
+        return min(burst, tokens + current * elapsed), current, blocked_until
+
+    # takes a token when there is one, returns how long to wait otherwise
+    def take(self, name: str) -> float:
+        with self.transaction() as db:
+            now = self.clock()
+            tokens, current, blocked_until = self.bucket(db, name, now)
+            if now < blocked_until:
+                return blocked_until - now
+            if tokens < 1:
+                return (1 - tokens) / current
+            db.execute("INSERT OR REPLACE INTO buckets VALUES (?, ?, ?, ?, ?)",
+                       (name, tokens - 1, current, now, blocked_until))
+            return 0
+
+    def acquire(self, name: str):
+        while (wait := self.take(name)) > 0:
+            self.sleep(wait)
+
+    # the server refused a call for wait seconds; calls throttled together slow the bucket down once
+    def throttled(self, name: str, wait: float):
+        rate, _ = self.rates[name]
+        with self.transaction() as db:
+            now = self.clock()
+            _, current, blocked_until = self.bucket(db, name, now)
+            if now >= blocked_until:
+                current = max(rate * self.min_share, current / 2)
+            # no tokens build up while blocked
+            blocked_until = max(blocked_until, now + wait)
+            db.execute("INSERT OR REPLACE INTO buckets VALUES (?, ?, ?, ?, ?)",
+                       (name, 0, current, blocked_until, blocked_until))
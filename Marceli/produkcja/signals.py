@@ -0,0 +1,42 @@
+from django.db.models.signals import pre_save, post_save, post_delete
+from django.dispatch import receiver
+from .models import InvoicePosition, ProductionPosition
+
+# delete receivers set-based deletes of the importer may skip: they only refresh production positions that are
+# purged along with them or rebuilt by the import
+PURGE_SAFE_RECEIVERS = {'invoice_position_deleted'}
+
+
+# keep stored sales of production positions and docs in step with single invoice position changes,
+# bulk writes skip signals and refresh the aggregates themselves
+
+def refresh_position_sales(production_position_id):
+    position = ProductionPosition.objects.filter(pk=production_position_id).select_related('production_doc').first()
+    if position:
+        position.refresh_sales()
+        position.production_doc.refresh_sales()
+
+
+@receiver(pre_save, sender=InvoicePosition)
+def remember_production_position(sender, instance, raw=False, **kwargs):
+    instance.previous_production_position_id = None
+    if instance.pk and not raw:
+        instance.previous_production_position_id = sender.objects.filter(pk=instance.pk)\
+            .values_list('production_position_id', flat=True).first()
+
+
+@receiver(post_save, sender=InvoicePosition)
+def invoice_position_saved(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    previous = getattr(instance, 'previous_production_position_id', None)
+    if previous and previous != instance.production_position_id:
+        refresh_position_sales(previous)
+    if instance.production_position_id:
+        refresh_position_sales(instance.production_position_id)
+
+
+@receiver(post_delete, sender=InvoicePosition, dispatch_uid='invoice_position_deleted')
+def invoice_position_deleted(sender, instance, **kwargs):
+    if instance.production_position_id:
+        refresh_position_sales(instance.production_position_id)
@@ -1,3 +1,444 @@
-from django.test import TestCase
+import email.utils
+import http.client
+import json
+import socketserver
+import tempfile
+import threading
+import time
+from datetime import date, timedelta
+from decimal import Decimal
+from unittest import mock
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from xmlrpc.server import MultiPathXMLRPCServer, SimpleXMLRPCDispatcher, SimpleXMLRPCRequestHandler
 
-# Create your tests here.
+import requests
+from django.db.models import Sum
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.utils import timezone
+
+from .fakturownia import ACTIONS_OVERLAP, PRODUCTS_WAREHOUSE_ID, Fakturownia, ProductBalances, retry_after, \
+    sync_warehouse_actions
+from .importer import OrderIndex, import_month
+from .logic import allocate, assign_raw_materials
+from .models import RW, InvoicePosition, Job, Month, Product, ProductionDoc, ProductionPosition, WarehouseAction
+from .odoo import Odoo, OdooUnavailable
+from .pipeline import claim_job
+from .resilience import CircuitBreaker, CircuitOpen, RateLimiter, Retry
+
+
+class AllocateTests(SimpleTestCase):
+    def test_parts_sum_to_amount(self):
+        for amount, weights in [
+            (Decimal('100.00'), [Decimal(1), Decimal(1), Decimal(1)]),
+            (Decimal('0.10'), [Decimal('3.3'), Decimal('3.3'), Decimal('3.4')]),
+            (Decimal('1234.57'), [Decimal('0.01'), Decimal('999.99'), Decimal('17'), Decimal('2.5')]),
+            (Decimal('-45.01'), [Decimal(2), Decimal(7)]),
+        ]:
+            with self.subTest(amount=amount, weights=weights):
+                self.assertEqual(sum(allocate(amount, weights)), amount)
+
+    def test_largest_remainders_get_the_cents(self):
+        self.assertEqual(allocate(Decimal('100.00'), [Decimal(1)] * 3),
+                         [Decimal('33.34'), Decimal('33.33'), Decimal('33.33')])
+        self.assertEqual(allocate(Decimal('1.00'), [Decimal(1), Decimal(2)]), [Decimal('0.33'), Decimal('0.67')])
+
+    def test_zero_total_goes_to_last_part(self):
+        self.assertEqual(allocate(Decimal('10.00'), [Decimal(0), Decimal(0)]), [Decimal(0), Decimal('10.00')])
+        self.assertEqual(allocate(Decimal('10.00'), [Decimal(5), Decimal(-5)]), [Decimal(0), Decimal('10.00')])
+        self.assertEqual(allocate(Decimal('10.00'), []), [])
+
+    def test_negative_weights(self):
+        parts = allocate(Decimal('0.10'), [-0.9, -0.9, 11.8])
+        self.assertEqual(sum(parts), Decimal('0.10'))
+        self.assertEqual(parts, [Decimal('-0.01'), Decimal('-0.01'), Decimal('0.12')])
+        self.assertEqual(sum(allocate(Decimal('7.77'), [Decimal(-3), Decimal(1), Decimal(5)])), Decimal('7.77'))
+
+
+# local stand-ins for fakturownia and odoo, run in a thread for the duration of a test
+
+class OrderIndexTests(SimpleTestCase):
+    def setUp(self):
+        self.docs = [ProductionDoc(order_number=order_number) for order_number in ["12/22", "123/22", "AB-7", "", " "]]
+        self.index = OrderIndex(self.docs)
+
+    def test_order_number_in_description(self):
+        self.assertIs(self.index.match("Wydanie surowców do 123/22 zamówienie"), self.docs[1])
+        self.assertIs(self.index.match("Wydanie surowców do 12/22"), self.docs[0])
+
+    def test_irregular_order_number_searched_in_description(self):
+        self.assertIs(self.index.match("Wydanie surowców do AB-7, pilne"), self.docs[2])
+        self.assertIs(self.index.match("zamówienie nr AB-7/B"), self.docs[2])
+
+    def test_blank_order_numbers_match_nothing(self):
+        self.assertIsNone(self.index.match("Wydanie surowców do 99/22"))
+        self.assertIsNone(self.index.match(""))
+        self.assertIsNone(self.index.match(None))
+        self.assertIsNone(OrderIndex([ProductionDoc(order_number="")]).match("Wydanie surowców"))
+
+
+class AssignRawMaterialsTests(TestCase):
+    def test_only_positions_in_odoo_updated(self):
+        month = Month.objects.create(year=2022, month=1)
+        rw = RW.objects.create(number="22/01/01", issue_date="2022-01-31", value=Decimal('10.00'))
+        doc = ProductionDoc.objects.create(month=month, order_number="1/22", rw=rw)
+        uploaded, new = [ProductionPosition.objects.create(production_doc=doc, odoo_id=odoo_id, value_pln=5,
+                                                           product=Product.objects.create(name=name, fakturownia_id=n))
+                         for n, (name, odoo_id) in enumerate([("uploaded", 7), ("new", None)])]
+        with mock.patch('produkcja.logic.odoo') as odoo:
+            assign_raw_materials(month)
+        self.assertEqual([position.raw_materials_value for position in
+                          ProductionPosition.objects.order_by('id')], [Decimal('5.00'), Decimal('5.00')])
+        odoo.update_position.assert_called_once_with(uploaded, {'x_studio_raw_materials_value': 5.0})
+
+
+class FakeFakturownia(BaseHTTPRequestHandler):
+    # answers with the statuses queued in server.answers, 200 when none is left
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def answer(self):
+        self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        self.server.requests.append(self.command)
+        status, headers = self.server.answers.pop(0) if self.server.answers else (200, {})
+        body = json.dumps({'id': len(self.server.requests)}).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_GET = do_POST = do_PUT = answer
+
+
+class FakeOdooObject:
+    # calls of methods in slow take longer than the client's timeout until slow_calls is used up
+    def __init__(self):
+        self.calls = []
+        self.slow = set()
+        self.slow_calls = 0
+
+    def execute_kw(self, db, uid, password, model, method, args, kwargs=None):
+        self.calls.append(method)
+        if method in self.slow and self.slow_calls:
+            self.slow_calls -= 1
+            time.sleep(0.5)
+        return 1 if method == 'create' else [{'id': 1}]
+
+
+class FakeOdooHandler(SimpleXMLRPCRequestHandler):
+    rpc_paths = ('/xmlrpc/2/common', '/xmlrpc/2/object')
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def decode_request_content(self, data):
+        self.server.encodings.append(self.headers.get('content-encoding'))
+        return super().decode_request_content(data)
+
+
+class FakeOdooServer(socketserver.ThreadingMixIn, MultiPathXMLRPCServer):
+    daemon_threads = True
+
+
+class FakeServerTestCase(SimpleTestCase):
+    def serve(self, server):
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        return f"http://127.0.0.1:{server.server_address[1]}"
+
+    def fakturownia_server(self):
+        server = ThreadingHTTPServer(('127.0.0.1', 0), FakeFakturownia)
+        server.requests, server.answers = [], []
+        return server, self.serve(server)
+
+    def limiter(self, rates=None):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        return RateLimiter(f"{directory.name}/ratelimit.sqlite3", rates or {
+            'fakturownia:read': (1000, 1000),
+            'fakturownia:write': (1000, 1000),
+        })
+
+
+class FakturowniaResilienceTests(FakeServerTestCase):
+    def setUp(self):
+        self.server, url = self.fakturownia_server()
+        self.sleeps = []
+        self.now = [0]
+        self.breaker = CircuitBreaker("Fakturownia", failure_threshold=2, reset_timeout=30,
+                                      clock=lambda: self.now[0])
+        self.client = Fakturownia("token", url, 2, timeout=(1, 1), breaker=self.breaker, limiter=self.limiter(),
+                                  retry=Retry(3, 0.1, 1, retry_on=(requests.ConnectionError, requests.Timeout),
+                                              sleep=self.sleeps.append))
+
+    def test_5xx_retried_then_success(self):
+        self.server.answers = [(503, {}), (502, {})]
+        self.breaker.failure_threshold = 5
+        response = self.client.get("warehouse_documents/1.json")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.server.requests, ['GET'] * 3)
+        self.assertEqual(len(self.sleeps), 2)
+        self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+
+    def test_post_not_retried(self):
+        self.server.answers = [(503, {})]
+        response = self.client.post("warehouse_documents.json", {})
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(self.server.requests, ['POST'])
+        self.assertEqual(self.sleeps, [])
+
+    def test_breaker_opens_and_recovers_through_half_open_trial(self):
+        self.server.answers = [(503, {})] * 10
+        with self.assertRaises(CircuitOpen):
+            self.client.get("warehouse_documents/1.json")
+        self.assertEqual(len(self.server.requests), 2)
+        self.assertEqual(self.breaker.state, CircuitBreaker.OPEN)
+
+        # fails fast while open
+        with self.assertRaises(CircuitOpen):
+            self.client.get("warehouse_documents/1.json")
+        self.assertEqual(len(self.server.requests), 2)
+
+        self.now[0] += 31
+        self.server.answers = []
+        self.assertEqual(self.client.get("warehouse_documents/1.json").status_code, 200)
+        self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+
+
+class OdooResilienceTests(FakeServerTestCase):
+    def setUp(self):
+        self.server = FakeOdooServer(('127.0.0.1', 0), requestHandler=FakeOdooHandler, logRequests=False,
+                                     allow_none=True)
+        self.server.encodings = []
+        common = SimpleXMLRPCDispatcher(allow_none=True)
+        common.register_function(lambda db, username, password, context: 7, 'authenticate')
+        self.object = FakeOdooObject()
+        models = SimpleXMLRPCDispatcher(allow_none=True)
+        models.register_instance(self.object)
+        self.server.add_dispatcher('/xmlrpc/2/common', common)
+        self.server.add_dispatcher('/xmlrpc/2/object', models)
+        url = self.serve(self.server)
+
+        odoo_settings = override_settings(ODOO_URL=url, ODOO_DB="db", ODOO_USERNAME="user", ODOO_PASSWORD="password",
+                                          ODOO_CONNECT_TIMEOUT=1)
+        odoo_settings.enable()
+        self.addCleanup(odoo_settings.disable)
+        self.client = Odoo(timeout=0.2, breaker=CircuitBreaker("Odoo", 10, 30),
+                           retry=Retry(3, 0, 0, retry_on=(OSError, http.client.HTTPException, OdooUnavailable),
+                                       sleep=lambda delay: None))
+
+    def test_create_not_retried_on_timeout(self):
+        self.object.slow, self.object.slow_calls = {'create'}, 1
+        with self.assertRaises(OSError):
+            self.client.create('x_rw', {'x_name': "RW 1"})
+        self.assertEqual(self.object.calls, ['create'])
+
+    def test_read_retried_on_timeout(self):
+        self.object.slow, self.object.slow_calls = {'read'}, 1
+        self.assertEqual(self.client.execute_kw('x_rw', 'read', [[1]]), [{'id': 1}])
+        self.assertEqual(self.object.calls, ['read', 'read'])
+
+    def test_large_requests_gzipped_when_compressing(self):
+        client = Odoo(timeout=1, compress=True, retry=Retry(1, 0, 0))
+        client.execute_kw('x_rw', 'read', [[1]])
+        client.create('x_rw', [{'x_name': f"RW {n}"} for n in range(100)])
+        self.assertEqual(self.server.encodings, [None, None, 'gzip'])
+        self.assertEqual(self.object.calls, ['read', 'create'])
+
+
+class RateLimiterTests(FakeServerTestCase):
+    def setUp(self):
+        self.now = [1000.0]
+        self.sleeps = []
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now[0] += seconds
+
+    def limiter(self, rates=None, path=None):
+        if path is None:
+            directory = tempfile.TemporaryDirectory()
+            self.addCleanup(directory.cleanup)
+            path = f"{directory.name}/ratelimit.sqlite3"
+        return RateLimiter(path, rates or {'fakturownia:read': (10, 2), 'fakturownia:write': (10, 2)},
+                           recovery=10, clock=lambda: self.now[0], sleep=self.sleep)
+
+    def test_budget_shared_through_the_file(self):
+        first = self.limiter()
+        second = self.limiter(path=first.path)  # as another process would open it
+        first.acquire('fakturownia:read')
+        first.acquire('fakturownia:read')
+        self.assertEqual(self.sleeps, [])
+        second.acquire('fakturownia:read')
+        self.assertAlmostEqual(sum(self.sleeps), 0.1)
+        # buckets are independent
+        second.acquire('fakturownia:write')
+        self.assertAlmostEqual(sum(self.sleeps), 0.1)
+
+    def test_throttled_blocks_until_retry_after(self):
+        limiter = self.limiter()
+        limiter.throttled('fakturownia:read', 5)
+        limiter.acquire('fakturownia:read')
+        self.assertGreaterEqual(sum(self.sleeps), 5)
+        self.assertLess(sum(self.sleeps), 5.5)
+
+    def test_rate_recovers_after_throttling(self):
+        limiter = self.limiter()
+        # threads throttled at the same time halve the rate once
+        limiter.throttled('fakturownia:read', 1)
+        limiter.throttled('fakturownia:read', 1)
+        with limiter.transaction() as db:
+            self.assertAlmostEqual(limiter.bucket(db, 'fakturownia:read', self.now[0])[1], 5)
+            # grows back over the 10 s recovery once the block ends
+            self.assertAlmostEqual(limiter.bucket(db, 'fakturownia:read', self.now[0] + 3.5)[1], 7.5)
+            self.assertAlmostEqual(limiter.bucket(db, 'fakturownia:read', self.now[0] + 6)[1], 10)
+
+    def test_429_waits_for_retry_after_without_opening_the_breaker(self):
+        server, url = self.fakturownia_server()
+        server.answers = [(429, {'Retry-After': '2'}), (429, {'Retry-After': '2'})]
+        breaker = CircuitBreaker("Fakturownia", failure_threshold=1)
+        client = Fakturownia("token", url, 2, timeout=(1, 1), breaker=breaker, limiter=self.limiter(),
+                             retry=Retry(0, retry_on=(requests.ConnectionError, requests.Timeout)))
+        response = client.post("warehouse_documents.json", {})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(server.requests, ['POST'] * 3)
+        self.assertGreaterEqual(sum(self.sleeps), 4)
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+
+    def test_retry_after_header(self):
+        class Response:
+            def __init__(self, value):
+                self.headers = {'Retry-After': value} if value else {}
+
+        self.assertEqual(retry_after(Response('7')), 7)
+        self.assertIsNone(retry_after(Response(None)))
+        self.assertIsNone(retry_after(Response('soon')))
+        self.assertEqual(retry_after(Response('Wed, 21 Oct 2015 07:28:00 GMT')), 0)
+        for usegmt in (True, False):  # False gives a -0000 zone
+            value = email.utils.formatdate(time.time() + 30, usegmt=usegmt)
+            self.assertAlmostEqual(retry_after(Response(value)), 30, delta=2)
+
+
+class FakeActionListing:
+    # warehouse_actions listing of fakturownia, oldest first and filtered by date_from like the api
+    def __init__(self, actions):
+        self.actions = actions
+        self.requests = []
+
+    def iter_pages(self, endpoint, parameters):
+        self.requests.append(parameters)
+        date_from = parameters.get('date_from', '')
+        yield [action for action in self.actions if action['created_at'][:10] >= date_from]
+
+
+class WarehouseLedgerTests(TestCase):
+    def setUp(self):
+        self.actions = [self.action(n, product_id=n % 3, quantity='1', day=n) for n in range(1, 21)]
+        self.listing = FakeActionListing(self.actions)
+        patcher = mock.patch('produkcja.fakturownia.fakturownia', self.listing)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def action(self, fakturownia_id, product_id, quantity, day):
+        created_at = (date(2022, 1, 1) + timedelta(days=day)).isoformat() + "T10:00:00.000+01:00"
+        return {'id': fakturownia_id, 'product_id': product_id, 'warehouse_id': 6033, 'quantity': quantity,
+                'created_at': created_at}
+
+    def balances(self):
+        return {product_id: int(balance) for product_id, balance in
+                WarehouseAction.objects.values_list('product_fakturownia_id').annotate(balance=Sum('quantity'))}
+
+    def test_incremental_sync_lists_only_recent_actions(self):
+        self.assertEqual(sync_warehouse_actions(), {'created': 20, 'updated': 0, 'deleted': 0})
+        self.assertNotIn('date_from', self.listing.requests[0])
+
+        self.actions.append(self.action(21, product_id=1, quantity='5', day=21))
+        self.assertEqual(sync_warehouse_actions(), {'created': 1, 'updated': 0, 'deleted': 0})
+        self.assertEqual(self.listing.requests[1]['date_from'],
+                         (date(2022, 1, 21) - ACTIONS_OVERLAP).isoformat())
+        self.assertEqual(self.balances(), {0: 6, 1: 12, 2: 7})
+
+    def test_recent_edits_synced_and_old_ones_left_to_full_sync(self):
+        sync_warehouse_actions()
+        self.actions[-1]['quantity'] = '3'  # within the overlap
+        self.actions[0]['quantity'] = '9'   # older than the overlap
+        del self.actions[1]
+        self.assertEqual(sync_warehouse_actions(), {'created': 0, 'updated': 1, 'deleted': 0})
+        self.assertEqual(sync_warehouse_actions(full=True), {'created': 0, 'updated': 1, 'deleted': 1})
+        self.assertEqual(self.balances(), {0: 6, 1: 15, 2: 8})
+
+    def test_balances_sync_only_when_missing(self):
+        product = Product.objects.create(name="product", fakturownia_id=1)
+        balances = ProductBalances()
+        self.assertEqual(balances.get(product), 7)
+        balances.prefetch([product])
+        self.assertEqual(len(self.listing.requests), 1)
+        balances.prefetch([])
+        self.assertEqual(len(self.listing.requests), 1)
+
+
+class ImportTests(TestCase):
+    def setUp(self):
+        self.documents = []
+        for target, value in [('produkcja.importer.request_invoices', lambda *args: iter(self.documents)),
+                              ('produkcja.importer.request_rws', lambda *args: iter([])),
+                              ('produkcja.fakturownia.fakturownia', FakeActionListing([]))]:
+            patcher = mock.patch(target, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def invoice(self, fakturownia_id, quantity):
+        return {'id': fakturownia_id, 'issue_date': "2022-01-10", 'number': f"FV/{fakturownia_id}",
+                'oid': str(fakturownia_id // 2), 'buyer_name': "buyer", 'warehouse_id': PRODUCTS_WAREHOUSE_ID,
+                'price_net': "30.00", 'currency': "PLN", 'exchange_rate': "1.0",
+                'updated_at': "2022-01-10T10:00:00.000+01:00",
+                'positions': [{'product_id': product_id, 'name': f"product {product_id}", 'quantity': quantity,
+                               'price_net': "10.00", 'total_price_net': "10.00", 'discount': None}
+                              for product_id in range(3)]}
+
+    # queries of a re-import where every invoice has changed positions
+    def reimport_queries(self, month, invoices):
+        self.documents = [self.invoice(fakturownia_id, quantity=1) for fakturownia_id in range(invoices)]
+        import_month(month)
+        self.documents = [self.invoice(fakturownia_id, quantity=2) for fakturownia_id in range(invoices)]
+        stats = import_month(month)
+        self.assertEqual(stats['invoice positions created'], invoices * 3)
+        self.assertEqual(stats['invoice positions deleted'], invoices * 3)
+        self.assertEqual(InvoicePosition.objects.filter(invoice__month=month, quantity=2).count(), invoices * 3)
+        return stats['queries']
+
+    def test_reimport_of_changed_positions_in_constant_queries(self):
+        self.assertEqual(self.reimport_queries(Month.objects.create(year=2022, month=1), 4),
+                         self.reimport_queries(Month.objects.create(year=2022, month=2), 40))
+
+
+class ClaimJobTests(TestCase):
+    def setUp(self):
+        self.month = Month.objects.create(year=2022, month=1)
+
+    def test_months_with_running_job_skipped(self):
+        Job.objects.create(month=self.month, step='import', status=Job.RUNNING)
+        Job.objects.create(month=self.month, step='sync')
+        other = Job.objects.create(month=Month.objects.create(year=2022, month=2), step='sync')
+        self.assertEqual(claim_job(), other)
+        self.assertIsNone(claim_job())
+
+    def test_job_of_month_started_meanwhile_not_claimed(self):
+        queued = Job.objects.create(month=self.month, step='sync')
+
+        # another worker claims a job of the month after the candidates were picked
+        def started_meanwhile():
+            Job.objects.create(month=self.month, step='import', status=Job.RUNNING)
+            return timezone.now()
+
+        with mock.patch('produkcja.pipeline.timezone') as pipeline_timezone:
+            pipeline_timezone.now.side_effect = started_meanwhile
+            self.assertIsNone(claim_job())
+        queued.refresh_from_db()
+        self.assertEqual(queued.status, Job.QUEUED)